@@ -0,0 +1,13 @@
+"""Fixtures shared by the benchmarks."""
+import torch
+import torch.nn.functional as F
+
+
+def dist_fn(x1, x2, dim=1):
+    """Cosine distance, the default --distance of main.py."""
+    return 1 - F.cosine_similarity(x1, x2, dim=dim)
+
+
+def zipf_freqs(vocab):
+    """Zipfian counts, sorted like a torchtext vocab."""
+    return 1e6 / torch.arange(1, vocab + 1, dtype=torch.float)
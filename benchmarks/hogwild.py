@@ -0,0 +1,91 @@
+"""Words/sec per core of skipgram + WordNet subspace training with --hogwild.
+
+Every worker is a forked process with one thread, training the shared
+model without locks on synthetic Zipfian batches, as main.py does with
+--hogwild N. The throughput counts the center words of the batches.
+
+    python benchmarks/hogwild.py --vocab 267735 --workers 1,2,4,8
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import model
+from common import dist_fn, zipf_freqs
+
+parser = argparse.ArgumentParser(description='Hogwild training benchmark')
+parser.add_argument('--vocab', type=int, default=33278)
+parser.add_argument('--emsize', type=int, default=300)
+parser.add_argument('--wn_hid', type=int, default=100)
+parser.add_argument('--batch_size', type=int, default=256, help='center words per step')
+parser.add_argument('--context', type=int, default=8, help='context words per center word')
+parser.add_argument('--pairs', type=int, default=100, help='pairs of every relation per step')
+parser.add_argument('--workers', type=str, default='1,2,4')
+parser.add_argument('--optim', type=str, default='sgd', help='sgd or adagrad')
+parser.add_argument('--steps', type=int, default=50, help='steps per worker')
+args = parser.parse_args()
+
+
+def worker(wn_lm, freqs, seed, results):
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    cls = torch.optim.Adagrad if args.optim == 'adagrad' else torch.optim.SGD
+    optimizer = cls(wn_lm.parameters(), lr=0.1)
+
+    def pairs():
+        return torch.multinomial(freqs, args.pairs * 2, replacement=True).view(-1, 2)
+
+    def step():
+        optimizer.zero_grad()
+        words = torch.multinomial(freqs, args.batch_size * (1 + args.context), replacement=True)
+        data, targets = words[:args.batch_size].view(1, -1), words[args.batch_size:].view(args.context, -1)
+        out = wn_lm(data, None, targets, pairs(), pairs(), pairs(), pairs())
+        loss = out['loss_lm'] + out['loss_syn'] + out['loss_ant'] + out['loss_hyp'] + out['loss_mer']
+        loss.backward()
+        for emb in (wn_lm.encoder, wn_lm.lm.decoder):
+            emb.weight.grad = emb.weight.grad.coalesce()
+        torch.nn.utils.clip_grad_norm_(wn_lm.parameters(), 0.25)
+        optimizer.step()
+
+    step()
+    start = time.time()
+    for _ in range(args.steps):
+        step()
+    results.put(time.time() - start)
+
+
+def run(num_workers):
+    torch.manual_seed(0)
+    freqs = zipf_freqs(args.vocab)
+    lm = model.SkipGramModel(args.vocab, args.emsize, freqs)
+    wn = model.WNModel(['syn', 'hyp', 'mer'], freqs, lm.encoder, args.emsize, args.wn_hid, 1, dist_fn=dist_fn)
+    wn_lm = model.WNLM(lm, wn)
+    for emb in (wn_lm.encoder, wn_lm.lm.decoder):
+        emb.sparse = True
+    wn_lm.share_memory()
+
+    ctx = mp.get_context('fork')
+    results = ctx.Queue()
+    workers = [ctx.Process(target=worker, args=(wn_lm, freqs, i, results)) for i in range(num_workers)]
+    for w in workers:
+        w.start()
+    elapsed = max(results.get() for _ in workers)
+    for w in workers:
+        w.join()
+    return num_workers * args.steps * args.batch_size / elapsed
+
+
+print('vocab {} emsize {} center words/step {} context {} pairs/relation {} optim {} cores {}'.format(
+    args.vocab, args.emsize, args.batch_size, args.context, args.pairs, args.optim, os.cpu_count()))
+print('{:>8s} {:>12s} {:>16s} {:>11s}'.format('workers', 'words/s', 'words/s/core', 'efficiency'))
+base = None
+for num_workers in [int(n) for n in args.workers.split(',')]:
+    words_per_sec = run(num_workers)
+    per_core = words_per_sec / num_workers
+    base = base or per_core
+    print('{:>8d} {:>12.0f} {:>16.0f} {:>10.0f}%'.format(num_workers, words_per_sec, per_core, 100 * per_core / base))
@@ -0,0 +1,90 @@
+"""Tokens/sec and peak memory of the RNN language model's criterion on CPU,
+full softmax against nce/sampled/mix at several noise ratios.
+
+Every setting runs in its own process and reports the growth of its peak
+resident memory over the memory after setup (Linux only).
+
+    python benchmarks/nce_losses.py --vocab 267735 --noise_ratios 64,1024,26773 --score_memory 256
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nce import IndexLinear, build_sampler
+from common import zipf_freqs
+
+parser = argparse.ArgumentParser(description='NCE loss benchmark')
+parser.add_argument('--vocab', type=int, default=33278)
+parser.add_argument('--nhid', type=int, default=200)
+parser.add_argument('--bptt', type=int, default=35)
+parser.add_argument('--batch_size', type=int, default=20)
+parser.add_argument('--noise_ratios', type=str, default='64,1024,0',
+                    help='comma separated, 0 stands for vocab / 10')
+parser.add_argument('--loss_types', type=str, default='nce,sampled,mix')
+parser.add_argument('--noise_sampler', type=str, default='unigram')
+parser.add_argument('--score_memory', type=int, default=0, help='MB, see --score_memory of main.py')
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--threads', type=int, default=1)
+parser.add_argument('--setting', type=str, default=None, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+
+def memory_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def run(loss_type, noise_ratio):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    freqs = zipf_freqs(args.vocab)
+    noise, sampler = build_sampler(args.noise_sampler, freqs)
+    criterion = IndexLinear(args.nhid, args.vocab, noise=noise, noise_ratio=noise_ratio or 1,
+                            loss_type=loss_type, sampler=sampler, score_memory=args.score_memory << 20)
+    output = torch.randn(args.bptt * args.batch_size, 1, args.nhid, requires_grad=True)
+    targets = torch.multinomial(freqs, args.bptt * args.batch_size, replacement=True).view(-1, 1)
+
+    def step():
+        criterion.zero_grad()
+        output.grad = None
+        criterion(targets, output).backward()
+
+    step()
+    # reset the peak resident memory to the current one
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    base = memory_kb('VmRSS')
+    start = time.time()
+    for _ in range(args.steps):
+        step()
+    elapsed = time.time() - start
+    return {'tokens_per_sec': args.steps * targets.size(0) / elapsed,
+            'peak_mb': (memory_kb('VmHWM') - base) / 1024.}
+
+
+if args.setting is not None:
+    loss_type, noise_ratio = args.setting.split(':')
+    print(json.dumps(run(loss_type, int(noise_ratio))))
+    sys.exit(0)
+
+settings = [('full', 0)]
+for noise_ratio in args.noise_ratios.split(','):
+    noise_ratio = int(noise_ratio) or int(args.vocab / 10)
+    settings += [(loss_type, noise_ratio) for loss_type in args.loss_types.split(',')]
+
+print('vocab {} nhid {} tokens/step {} sampler {} score_memory {}MB'.format(
+    args.vocab, args.nhid, args.bptt * args.batch_size, args.noise_sampler, args.score_memory))
+print('{:>8s} {:>11s} {:>12s} {:>12s}'.format('loss', 'noise_ratio', 'tokens/s', 'peak MB'))
+for loss_type, noise_ratio in settings:
+    out = subprocess.check_output([sys.executable] + sys.argv + ['--setting', '{}:{}'.format(loss_type, noise_ratio)])
+    result = json.loads(out.decode().strip().splitlines()[-1])
+    print('{:>8s} {:>11s} {:>12.0f} {:>12.1f}'.format(loss_type, str(noise_ratio) if noise_ratio else '-',
+                                                       result['tokens_per_sec'], result['peak_mb']))
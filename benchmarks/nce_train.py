@@ -0,0 +1,71 @@
+"""Times an NCE training step of the RNN language model's criterion on CPU.
+
+    python benchmarks/nce_train.py --vocab 33278 --noise_buffer 1000000
+    python benchmarks/nce_train.py --noise_sampler log_uniform --noise_ratio 1024
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nce import IndexLinear, build_sampler
+from common import zipf_freqs
+
+parser = argparse.ArgumentParser(description='NCE training step benchmark')
+parser.add_argument('--vocab', type=int, default=33278)
+parser.add_argument('--nhid', type=int, default=200)
+parser.add_argument('--bptt', type=int, default=35)
+parser.add_argument('--batch_size', type=int, default=20)
+parser.add_argument('--noise_ratio', type=int, default=0,
+                    help='noise samples per step (0 uses vocab / 10 like RNNModel)')
+parser.add_argument('--noise_buffer', type=int, default=1000000,
+                    help='buffer size timed against drawing the noise every step')
+parser.add_argument('--noise_sampler', type=str, default='unigram')
+parser.add_argument('--noise_power', type=float, default=1.)
+parser.add_argument('--per_word', action='store_true', help='draw separate noises for every target')
+parser.add_argument('--loss_type', type=str, default='nce')
+parser.add_argument('--steps', type=int, default=50)
+parser.add_argument('--threads', type=int, default=1)
+args = parser.parse_args()
+
+torch.set_num_threads(args.threads)
+
+freqs = zipf_freqs(args.vocab)
+noise_ratio = args.noise_ratio or int(args.vocab / 10)
+
+
+def timed(fn):
+    for _ in range(5):
+        fn()
+    start = time.time()
+    for _ in range(args.steps):
+        fn()
+    return (time.time() - start) / args.steps * 1000
+
+
+def run(noise_buffer):
+    torch.manual_seed(0)
+    noise, sampler = build_sampler(args.noise_sampler, freqs, args.noise_power)
+    criterion = IndexLinear(args.nhid, args.vocab, noise=noise, noise_ratio=noise_ratio,
+                            loss_type=args.loss_type, per_word=args.per_word,
+                            noise_buffer=noise_buffer, sampler=sampler)
+    output = torch.randn(args.bptt * args.batch_size, 1, args.nhid, requires_grad=True)
+    targets = torch.multinomial(freqs, args.bptt * args.batch_size, replacement=True).view(-1, 1)
+
+    def step():
+        criterion.zero_grad()
+        criterion(targets, output).backward()
+
+    return timed(step), timed(lambda: criterion.get_noise(targets.size(0), targets.size(1)))
+
+
+print('vocab {} noise ratio {} sampler {} per_word {} loss {}'.format(
+    args.vocab, noise_ratio, args.noise_sampler, args.per_word, args.loss_type))
+tokens = args.bptt * args.batch_size
+for noise_buffer in (0, args.noise_buffer):
+    step_ms, noise_ms = run(noise_buffer)
+    print('noise_buffer {:>8d}: {:7.2f} ms/step ({:6.0f} tokens/s), noise {:6.3f} ms/step'.format(
+        noise_buffer, step_ms, tokens / step_ms * 1000, noise_ms))
@@ -0,0 +1,79 @@
+"""Times a training step of the shared word embeddings on CPU, dense against --sparse_emb.
+
+The step is what main.py does for the embedding table: look up a batch of
+tokens and the relation pairs of WNModel, backward, clip, update.
+
+    python benchmarks/sparse_emb.py --vocab 267735 --emsize 600 --optim adam
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import model
+from common import dist_fn, zipf_freqs
+
+parser = argparse.ArgumentParser(description='Sparse embedding gradient benchmark')
+parser.add_argument('--vocab', type=int, default=267735)
+parser.add_argument('--emsize', type=int, default=600, help='e.g. 300 + 3 * 100 with --extend_wn')
+parser.add_argument('--wn_hid', type=int, default=100)
+parser.add_argument('--tokens', type=int, default=35 * 80, help='tokens per step')
+parser.add_argument('--pairs', type=int, default=500, help='pairs of every relation per step')
+parser.add_argument('--optim', type=str, default='sgd,adagrad,adam')
+parser.add_argument('--clip', type=float, default=0.25)
+parser.add_argument('--steps', type=int, default=10)
+parser.add_argument('--threads', type=int, default=1)
+args = parser.parse_args()
+
+torch.set_num_threads(args.threads)
+
+
+def run(optim, sparse):
+    torch.manual_seed(0)
+    freqs = zipf_freqs(args.vocab)
+    encoder = nn.Embedding(args.vocab, args.emsize, sparse=sparse)
+    wn = model.WNModel(['syn', 'hyp', 'mer'], freqs, encoder, args.emsize, args.wn_hid, 1, dist_fn=dist_fn)
+    # stands in for the language model on top of the embeddings
+    lm = nn.Linear(args.emsize, 1)
+    params = list(encoder.parameters()) + list(wn.parameters()) + list(lm.parameters())
+    dense_params = [p for p in params if p is not encoder.weight]
+
+    if optim == 'adam' and sparse:
+        optimizers = [torch.optim.Adam(dense_params), torch.optim.SparseAdam([encoder.weight])]
+    else:
+        cls = {'sgd': torch.optim.SGD, 'adagrad': torch.optim.Adagrad, 'adam': torch.optim.Adam}[optim]
+        optimizers = [cls([encoder.weight] + dense_params, lr=0.1)]
+
+    def pairs():
+        return torch.multinomial(freqs, args.pairs * 2, replacement=True).view(-1, 2)
+
+    def step():
+        for opt in optimizers:
+            opt.zero_grad()
+        tokens = torch.multinomial(freqs, args.tokens, replacement=True)
+        out = wn(pairs(), pairs(), pairs(), pairs())
+        loss = lm(encoder(tokens)).mean() + out['loss_syn'] + out['loss_ant'] + out['loss_hyp'] + out['loss_mer']
+        loss.backward()
+        if sparse:
+            encoder.weight.grad = encoder.weight.grad.coalesce()
+        torch.nn.utils.clip_grad_norm_(params, args.clip)
+        for opt in optimizers:
+            opt.step()
+
+    for _ in range(2):
+        step()
+    start = time.time()
+    for _ in range(args.steps):
+        step()
+    return (time.time() - start) / args.steps * 1000
+
+
+print('vocab {} emsize {} tokens/step {} pairs/relation {}'.format(args.vocab, args.emsize, args.tokens, args.pairs))
+for optim in args.optim.split(','):
+    dense_ms = run(optim, False)
+    sparse_ms = run(optim, True)
+    print('{:>8s}: dense {:8.1f} ms/step, sparse {:8.1f} ms/step'.format(optim, dense_ms, sparse_ms))
@@ -0,0 +1,110 @@
+"""Times WNModel forward + backward on CPU against the former per-relation forward.
+
+    python benchmarks/wn_forward.py --pairs 500 --negs 10 --shared_negs 1000
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import model
+from common import dist_fn
+
+parser = argparse.ArgumentParser(description='WNModel forward benchmark')
+parser.add_argument('--vocab', type=int, default=33278)
+parser.add_argument('--emsize', type=int, default=300)
+parser.add_argument('--wn_hid', type=int, default=100)
+parser.add_argument('--pairs', type=int, default=500,
+                    help='pairs of every relation per step')
+parser.add_argument('--negs', type=int, default=10)
+parser.add_argument('--shared_negs', type=int, default=0,
+                    help='also time a WNModel sharing a pool of this many negatives per step')
+parser.add_argument('--steps', type=int, default=50)
+parser.add_argument('--threads', type=int, default=1)
+args = parser.parse_args()
+
+torch.set_num_threads(args.threads)
+
+
+def unfused_forward(wn, synonyms, antonyms, hypernyms, meronyms):
+    """The forward pass before it was fused, one block per relation."""
+    def negatives(batch_size):
+        return torch.multinomial(wn.weights, batch_size * wn.n_negs, replacement=True).view(batch_size, -1)
+
+    output_dict = {}
+    batch_size = synonyms.size(0)
+    emb_syn1 = wn.syn_proj(wn.embedding(synonyms[:, 0]))
+    emb_syn2 = wn.syn_proj(wn.embedding(synonyms[:, 1]))
+    nwords = negatives(batch_size)
+    emb_syn_neg = wn.syn_proj(wn.embedding(nwords).view(-1, wn.emb_dim)).view(batch_size, wn.n_negs, -1)
+    output_dict['loss_syn'] = torch.sum(wn.dist_fn(emb_syn1, emb_syn2)
+                                        + wn.neg_wn_ratio * F.relu(wn.n_margin - wn.dist_fn(emb_syn1.unsqueeze(1), emb_syn_neg, dim=2)).mean(1)
+                                        ) / max(batch_size, 1)
+
+    batch_size = antonyms.size(0)
+    emb_ant1 = wn.syn_proj(wn.embedding(antonyms[:, 0]))
+    emb_ant2 = wn.syn_proj(wn.embedding(antonyms[:, 1]))
+    nwords = negatives(batch_size)
+    emb_ant_neg = wn.syn_proj(wn.embedding(nwords).view(-1, wn.emb_dim)).view(batch_size, wn.n_negs, -1)
+    output_dict['loss_ant'] = torch.sum(F.relu(wn.antonym_margin - wn.dist_fn(emb_ant1, emb_ant2))
+                                        + wn.neg_wn_ratio * F.relu(wn.dist_fn(emb_ant1.unsqueeze(1), emb_ant_neg, dim=2) - 1.5).mean(1)
+                                        ) / max(batch_size, 1)
+
+    batch_size = hypernyms.size(0)
+    emb_hypn1 = wn.hypn_proj(wn.embedding(hypernyms[:, 0]))
+    emb_hypn2 = wn.hypn_proj(wn.embedding(hypernyms[:, 1]))
+    emb_hypn1_rel = wn.hypn_rel(emb_hypn1)
+    nwords = negatives(batch_size)
+    emb_hyp_neg = wn.hypn_rel(wn.hypn_proj(wn.embedding(nwords).view(-1, wn.emb_dim)).view(batch_size, wn.n_negs, -1))
+    output_dict['loss_hyp'] = torch.sum(wn.dist_fn(emb_hypn1_rel, emb_hypn2)
+                                        + F.relu(1 - wn.dist_fn(wn.hypn_rel(emb_hypn2), emb_hypn1))
+                                        + wn.neg_wn_ratio * F.relu(1 - wn.dist_fn(emb_hypn2.unsqueeze(1), emb_hyp_neg, dim=2)).mean(1)
+                                        ) / max(batch_size, 1)
+
+    batch_size = meronyms.size(0)
+    emb_mern1 = wn.mern_proj(wn.embedding(meronyms[:, 0]))
+    emb_mern2 = wn.mern_proj(wn.embedding(meronyms[:, 1]))
+    emb_mern1_rel = wn.mern_rel(emb_mern1)
+    nwords = negatives(batch_size)
+    emb_mer_neg = wn.mern_rel(wn.mern_proj(wn.embedding(nwords).view(-1, wn.emb_dim)).view(batch_size, wn.n_negs, -1))
+    output_dict['loss_mer'] = torch.sum(wn.dist_fn(emb_mern1_rel, emb_mern2)
+                                        + wn.neg_wn_ratio * F.relu(wn.n_margin - wn.dist_fn(emb_mern2.unsqueeze(1), emb_mer_neg, dim=2)).mean(1)
+                                        + F.relu(1 - wn.dist_fn(wn.mern_rel(emb_mern2), emb_mern1))
+                                        ) / max(batch_size, 1)
+    return output_dict
+
+
+def run(forward, wn, pairs):
+    optimizer = torch.optim.SGD(wn.parameters(), lr=0.01)
+    for step in range(args.steps + 5):
+        if step == 5:
+            start = time.time()
+        optimizer.zero_grad()
+        output_dict = forward(*pairs)
+        sum(v for k, v in output_dict.items() if k.startswith('loss')).backward()
+        optimizer.step()
+    return (time.time() - start) * 1000 / args.steps
+
+
+torch.manual_seed(0)
+embedding = nn.Embedding(args.vocab, args.emsize)
+freq = torch.rand(args.vocab)
+wn = model.WNModel(['syn', 'hyp', 'mer'], freq, embedding, args.emsize, args.wn_hid, 1,
+                   dist_fn=dist_fn, num_neg_samples=args.negs)
+pairs = [torch.randint(2, args.vocab, (args.pairs, 2)) for _ in range(4)]
+
+unfused = run(lambda *p: unfused_forward(wn, *p), wn, pairs)
+fused = run(wn, wn, pairs)
+print('pairs/relation {} | negs {} | unfused {:7.2f} ms/step | fused {:7.2f} ms/step | speedup {:4.2f}x'.format(
+    args.pairs, args.negs, unfused, fused, unfused / fused))
+
+if args.shared_negs > 0:
+    wn.shared_negs = args.shared_negs
+    shared = run(wn, wn, pairs)
+    print('pairs/relation {} | shared pool {} | {:7.2f} ms/step | speedup {:4.2f}x'.format(
+        args.pairs, args.shared_negs, shared, unfused / shared))
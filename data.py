@@ -1,5 +1,13 @@
+import codecs
+import copy
+import json
+import math
 import os
+from collections import Counter
+
+import numpy as np
 import torch
+import torchtext
 
 class Dictionary(object):
     def __init__(self):
@@ -46,3 +54,337 @@ class Corpus(object):
                     token += 1
 
         return ids
+
+
+class RaggedCorpus(object):
+    """Binary annotated corpus written by `preprocessing/main.py --binary`.
+
+    Every field is memory-mapped as a flat id array plus int64 offsets, so
+    loading it does not create any Python object per example.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.num_examples = meta['num_examples']
+        self.sequence_fields = meta['sequence_fields']
+        self.relation_fields = meta['relation_fields']
+
+        with codecs.open(os.path.join(path, 'words.txt'), 'r', encoding='utf-8') as f:
+            self.words = [line.rstrip('\n') for line in f]
+        self.counts = np.load(os.path.join(path, 'counts.npy'))
+
+        self.data = {}
+        self.offsets = {}
+        for field in self.sequence_fields + self.relation_fields:
+            self.offsets[field] = self._load(path, field + '_offsets.bin', np.int64)
+            self.data[field] = self._load(path, field + '.bin', np.int32)
+            if field in self.relation_fields:
+                self.data[field] = self.data[field].reshape(-1, 2)
+
+    @staticmethod
+    def _load(path, name, dtype):
+        path = os.path.join(path, name)
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return self.num_examples
+
+    def freqs(self, lower=False):
+        """Word counts over text and target, what the vocabulary is built from."""
+        freqs = Counter()
+        for w, c in zip(self.words, self.counts.tolist()):
+            freqs[w.lower() if lower else w] += c
+        return freqs
+
+
+class ExampleCorpus(object):
+    """In-memory corpus with the layout of RaggedCorpus, holding ids of `words`.
+
+    Used to cache torchtext examples as a handful of arrays instead of
+    pickling one Python object per example.
+    """
+    sequence_fields = ['text', 'target']
+
+    def __init__(self, words, data, offsets, relation_fields):
+        self.words = words
+        self.data = data
+        self.offsets = offsets
+        self.relation_fields = relation_fields
+
+    def __len__(self):
+        return len(self.offsets['text']) - 1
+
+    @classmethod
+    def from_examples(cls, examples, vocab, relation_fields):
+        """Numericalizes preprocessed torchtext examples with `vocab`."""
+        stoi = vocab.stoi
+        data = {}
+        offsets = {}
+        for field in cls.sequence_fields + relation_fields:
+            ids = []
+            ends = [0]
+            for ex in examples:
+                if field in relation_fields:
+                    a, b = getattr(ex, field + '_a'), getattr(ex, field + '_b')
+                    # empty relation lists were replaced with a single <pad>
+                    if a != ['<pad>']:
+                        ids.extend(stoi[w] for pair in zip(a, b) for w in pair)
+                    ends.append(len(ids) // 2)
+                else:
+                    ids.extend(stoi[w] for w in getattr(ex, field))
+                    ends.append(len(ids))
+
+            data[field] = np.array(ids, dtype=np.int32)
+            if field in relation_fields:
+                data[field] = data[field].reshape(-1, 2)
+            offsets[field] = np.array(ends, dtype=np.int64)
+        return cls(vocab.itos, data, offsets, relation_fields)
+
+    def state_dict(self):
+        return {'data': self.data, 'offsets': self.offsets, 'relation_fields': self.relation_fields}
+
+    @classmethod
+    def from_state_dict(cls, state, words):
+        return cls(words, state['data'], state['offsets'], state['relation_fields'])
+
+
+class RelationSampler(object):
+    """Draws relation pairs from the global pair tables written by preprocessing.
+
+    Every call to `sample` returns `pairs_per_step` (a, b) pairs of every
+    relation, walking through a fresh permutation of each table so that all
+    pairs are seen once per pass. Pairs with a word outside the vocab are
+    dropped. The tables of the relations trained on (`lex_rels`, as given
+    to main.py --lex) must exist and have pairs in the vocab.
+
+    `seeded` gives a sampler over the same tables drawing a fixed sequence of
+    pairs, e.g. for evaluation, without advancing this one.
+    """
+    files = [('synonyms', 'syn_v{}.txt'), ('antonyms', 'ant_v{}.txt'),
+             ('hypernyms', 'hyp_v{}.txt'), ('meronyms', 'mer_v{}.txt')]
+    # the --lex option training on each relation
+    lex = {'synonyms': 'syn', 'antonyms': 'syn', 'hypernyms': 'hyp', 'meronyms': 'mer'}
+
+    def __init__(self, pair_dir, version, vocab, pairs_per_step, device, lower=False, lex_rels=()):
+        self.pairs_per_step = pairs_per_step
+        self.device = device
+        self.tables = {}
+        self.perms = {}
+        self.positions = {}
+        self.seed = None
+        self.generator = None
+
+        unk_idx = vocab.stoi['<unk>']
+        for rel, filename in self.files:
+            pairs = []
+            path = os.path.join(pair_dir, filename.format(version))
+            if os.path.exists(path):
+                with codecs.open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        words = line.split()
+                        if len(words) != 2:
+                            continue
+                        pair = [vocab.stoi[w.lower() if lower else w] for w in words]
+                        if unk_idx not in pair:
+                            pairs.append(pair)
+            elif self.lex[rel] in lex_rels:
+                raise FileNotFoundError('No pair table for {}: {}'.format(rel, path))
+            else:
+                print('No pair table for {}: {}'.format(rel, path))
+
+            if not pairs and self.lex[rel] in lex_rels:
+                raise ValueError('No {} pair of {} is in the vocab'.format(rel, path))
+            print('Loaded {} {} pairs'.format(len(pairs), rel))
+            self.tables[rel] = torch.tensor(pairs, dtype=torch.long).view(-1, 2).to(device)
+            self.positions[rel] = len(pairs)
+
+    def next_pairs(self, rel):
+        table = self.tables[rel]
+        n = table.size(0)
+        if n == 0:
+            return table
+
+        chunks = []
+        needed = self.pairs_per_step
+        while needed > 0:
+            if self.positions[rel] >= n:
+                if self.generator is None:
+                    self.perms[rel] = torch.randperm(n, device=table.device)
+                else:
+                    self.perms[rel] = torch.randperm(n, generator=self.generator).to(table.device)
+                self.positions[rel] = 0
+            take = min(needed, n - self.positions[rel])
+            chunks.append(self.perms[rel][self.positions[rel]:self.positions[rel] + take])
+            self.positions[rel] += take
+            needed -= take
+        return table[torch.cat(chunks)]
+
+    def sample(self):
+        """Returns the synonym, antonym, hypernym and meronym pairs of a step."""
+        return tuple(self.next_pairs(rel) for rel, _ in self.files)
+
+    def seeded(self, seed):
+        """A sampler sharing the tables of this one whose draws only depend on `seed`."""
+        sampler = copy.copy(self)
+        sampler.seed = seed
+        sampler.generator = torch.Generator()
+        sampler.reset()
+        return sampler
+
+    def reset(self):
+        """Starts the sequence of pairs of a seeded sampler over."""
+        self.generator.manual_seed(self.seed)
+        self.perms = {}
+        self.positions = {rel: self.tables[rel].size(0) for rel, _ in self.files}
+
+
+class Batch(object):
+    def to(self, device):
+        for k, v in self.__dict__.items():
+            if isinstance(v, np.ndarray):
+                setattr(self, k, torch.from_numpy(v).to(device))
+        return self
+
+
+class BatchIterator(object):
+    """Iterates over a RaggedCorpus or ExampleCorpus in padded (seq_len, batch) batches.
+
+    Batches carry `text` and `target` with the layout of the torchtext
+    iterators, and every relation of the corpus as a (num_pairs, 2) tensor of
+    its pairs with the padding already dropped. With `num_workers > 0` batches are assembled
+    by a DataLoader in background processes, `prefetch` batches ahead per
+    worker, which are kept from one epoch to the next. After `shard` only a part of the batches is iterated over.
+    """
+    def __init__(self, corpus, vocab, batch_size, device, lower=False, shuffle=False,
+                 num_workers=0, prefetch=2):
+        self.corpus = corpus
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.pad_idx = vocab.stoi['<pad>']
+        # maps the ids of the corpus to the ids of the vocab
+        self.lookup = np.array([vocab.stoi[w.lower() if lower else w] for w in corpus.words],
+                               dtype=np.int64)
+        self.num_shards = 1
+        self.shard_id = 0
+        self.drop_last = False
+        # batches of the current epoch, read by the DataLoader
+        self.order = []
+        self.loader = None
+
+    def shard(self, num_shards, shard_id, drop_last=False):
+        """Only iterate over the `shard_id`-th of `num_shards` contiguous parts of the batches.
+
+        The batches are split after shuffling, so the shards of an epoch are
+        disjoint as long as every process seeds numpy the same way. With
+        `drop_last` all shards get the same number of batches and the
+        remainder is left out, as needed for steps synchronized across
+        processes.
+        """
+        self.num_shards = num_shards
+        self.shard_id = shard_id
+        self.drop_last = drop_last
+        return self
+
+    def shard_range(self, num_batches):
+        if self.drop_last:
+            size = num_batches // self.num_shards
+            return self.shard_id * size, (self.shard_id + 1) * size
+        return (self.shard_id * num_batches // self.num_shards,
+                (self.shard_id + 1) * num_batches // self.num_shards)
+
+    def __len__(self):
+        start, end = self.shard_range(int(math.ceil(len(self.corpus) / self.batch_size)))
+        return end - start
+
+    def gather(self, field, examples, min_len=0):
+        starts = self.corpus.offsets[field][examples]
+        lens = self.corpus.offsets[field][examples + 1] - starts
+        total = int(lens.sum())
+        seq_len = max(int(lens.max()), min_len)
+
+        cols = np.repeat(np.arange(len(examples)), lens)
+        rows = np.arange(total) - np.repeat(np.cumsum(lens) - lens, lens)
+        src = np.repeat(starts, lens) + rows
+        return src, rows, cols, seq_len
+
+    def padded(self, ids, rows, cols, seq_len, batch_size):
+        out = np.full((seq_len, batch_size), self.pad_idx, dtype=np.int64)
+        out[rows, cols] = self.lookup[ids]
+        return out
+
+    def batch(self, examples):
+        """Assembles the batch of the given examples as numpy arrays.
+
+        Arrays are cheaper than tensors to send from the loader workers,
+        `Batch.to` turns them into tensors on the device.
+        """
+        batch = Batch()
+        batch.batch_size = len(examples)
+        for field in self.corpus.sequence_fields:
+            src, rows, cols, seq_len = self.gather(field, examples)
+            setattr(batch, field, self.padded(self.corpus.data[field][src], rows, cols, seq_len, len(examples)))
+
+        for field in self.corpus.relation_fields:
+            src, rows, cols, seq_len = self.gather(field, examples)
+            pairs = self.corpus.data[field][src]
+            # same pair order as stacking the padded (seq_len, batch) `_a` and
+            # `_b` fields, minus the rows whose first word is padding
+            a = self.padded(pairs[:, 0], rows, cols, seq_len, len(examples)).ravel()
+            b = self.padded(pairs[:, 1], rows, cols, seq_len, len(examples)).ravel()
+            keep = a != self.pad_idx
+            setattr(batch, field, np.stack((a[keep], b[keep]), axis=1))
+        return batch
+
+    def __getitem__(self, examples):
+        return self.batch(examples)
+
+    def __iter__(self):
+        order = np.arange(len(self.corpus))
+        if self.shuffle:
+            np.random.shuffle(order)
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        start, end = self.shard_range(len(batches))
+        batches = batches[start:end]
+
+        if self.num_workers > 0:
+            # the sampler is read in this process, so the workers see the new order
+            self.order[:] = batches
+            if self.loader is None:
+                self.loader = torch.utils.data.DataLoader(self, batch_size=None, sampler=self.order,
+                                                          num_workers=self.num_workers,
+                                                          prefetch_factor=self.prefetch,
+                                                          persistent_workers=True)
+            batches = self.loader
+        else:
+            batches = (self.batch(examples) for examples in batches)
+
+        for batch in batches:
+            yield batch.to(self.device)
+
+
+def load_binary_iters(dataset_dir, batch_size, device, lower=False, max_size=None, vectors=None, shuffle=False,
+                      num_workers=0, prefetch=2, relations=True):
+    """Same as `Dataset.iters` in main.py, for corpora written with --binary.
+
+    With `relations=False` the relation pairs stored with the examples are
+    left out of the batches.
+    """
+    train, valid, test = [RaggedCorpus(os.path.join(dataset_dir, split + '.bin'))
+                          for split in ['train', 'valid', 'test']]
+    if not relations:
+        for corpus in (train, valid, test):
+            corpus.relation_fields = []
+
+    vocab = torchtext.vocab.Vocab(train.freqs(lower), max_size=max_size,
+                                  specials=['<unk>', '<pad>'], vectors=vectors)
+
+    train_iter, valid_iter, test_iter = [BatchIterator(corpus, vocab, batch_size, device, lower,
+                                                       shuffle=shuffle and corpus is train,
+                                                       num_workers=num_workers, prefetch=prefetch)
+                                         for corpus in (train, valid, test)]
+    return train_iter, valid_iter, test_iter, vocab, vocab.vectors
@@ -0,0 +1,178 @@
+"""Writers for the learnt embeddings.
+
+A matrix is written block by block of rows, every block going to the
+writers of all requested formats, so only one block of a (projected)
+embedding matrix is in memory at a time. The formats are
+
+    - npy: float32 numpy array, memory-mappable with `np.load(path, mmap_mode='r')`
+    - bin: word2vec binary format
+    - txt: one line per word, the word followed by its values
+    - pkl: pickled torch tensor, as read by analogy_tasks/main.py
+"""
+import os
+import pickle
+
+import numpy as np
+import torch
+
+FORMATS = ['npy', 'bin', 'txt', 'pkl']
+
+
+def _table(strings):
+    return np.frombuffer(''.join(strings).encode('latin-1'), dtype=np.uint8)
+
+
+# A value is written as 16 characters, e.g. ' -1.23450000e-02' for -0.012345,
+# in four parts of 4 characters looked up from these tables. Null characters
+# are dropped from the output: the missing sign, the trailing zeros of the
+# fraction and the point if there is no fraction left, giving ' -1.2345e-02'.
+# 9 significant digits are enough to read back every float32 exactly.
+#
+# separator, sign, leading digit and point, by 20 * negative + 2 * digit + has fraction
+_HEAD = _table(' ' + sign + str(d) + point for sign in ('\0', '-') for d in range(10)
+               for point in ('\0', '.')).view(np.uint32)
+# 4 digits of the fraction
+_QUAD = _table('%04d' % i for i in range(10000)).view(np.uint32)
+# exponents from -64 to 63, float32 only needs -45 to 38
+_EXP = _table('e%+03d' % e for e in range(-64, 64)).view(np.uint32)
+# number of trailing zeros of 4 digits, and masks dropping the n last of 8 digits
+_TRAILING = np.array([4] + [len('%04d' % i) - len(('%04d' % i).rstrip('0')) for i in range(1, 10000)])
+_MASK = _table('\xff' * (8 - n) + '\0' * n for n in range(9)).view(np.uint32).reshape(9, 2)
+
+
+def format_text(words, block):
+    """Lines of `words` followed by the values of the rows of `block`, as bytes.
+
+    The characters of all values are assembled with array operations
+    instead of formatting every value in Python.
+    """
+    block = np.asarray(block, dtype=np.float32)
+    if not np.isfinite(block).all():
+        return ''.join(w + ' ' + ' '.join('%.9g' % x for x in row) + '\n'
+                       for w, row in zip(words, block.tolist())).encode('utf-8')
+
+    x = block.astype(np.float64)
+    ax = np.abs(x)
+    nonzero = ax > 0
+    exp = np.floor(np.log10(np.where(nonzero, ax, 1.))).astype(np.int64)
+    mantissa = np.rint(ax / 10. ** exp * 1e8).astype(np.int64)
+    # log10 can be off by one next to the powers of 10
+    wrong = (mantissa >= 10 ** 9) | (nonzero & (mantissa < 10 ** 8))
+    if wrong.any():
+        exp[wrong] += np.where(mantissa[wrong] >= 10 ** 9, 1, -1)
+        mantissa[wrong] = np.rint(ax[wrong] / 10. ** exp[wrong] * 1e8)
+
+    lead, fraction = np.divmod(mantissa, 10 ** 8)
+    high, low = np.divmod(fraction, 10 ** 4)
+    trailing = np.where(low == 0, 4 + _TRAILING[high], _TRAILING[low])
+
+    field = np.empty(x.shape + (4,), dtype=np.uint32)
+    field[..., 0] = _HEAD[20 * (x < 0) + 2 * lead + (trailing < 8)]
+    field[..., 1] = _QUAD[high]
+    field[..., 2] = _QUAD[low]
+    field[..., 3] = _EXP[exp + 64]
+    field[..., 1:3] &= _MASK[trailing]
+
+    # the words are null padded to the longest one of the block
+    names = np.array([w.encode('utf-8') for w in words], dtype=bytes)
+    names = names.view(np.uint8).reshape(len(words), -1)
+    lines = np.concatenate([names, field.view(np.uint8).reshape(len(words), -1),
+                            np.full((len(words), 1), ord('\n'), dtype=np.uint8)], axis=1)
+    return lines[lines != 0].tobytes()
+
+
+class NpyWriter(object):
+    def __init__(self, path, num_rows, dim):
+        self.path = path
+        self.f = open(path, 'wb')
+        np.lib.format.write_array_header_1_0(self.f, {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                                                      'fortran_order': False, 'shape': (num_rows, dim)})
+
+    def write(self, words, block):
+        self.f.write(np.ascontiguousarray(block, dtype=np.float32).tobytes())
+
+    def close(self):
+        self.f.close()
+
+
+class Word2VecWriter(object):
+    def __init__(self, path, num_rows, dim):
+        self.f = open(path, 'wb')
+        self.f.write('{} {}\n'.format(num_rows, dim).encode('utf-8'))
+
+    def write(self, words, block):
+        block = np.ascontiguousarray(block, dtype=np.float32)
+        self.f.write(b''.join(w.encode('utf-8') + b' ' + row.tobytes() + b'\n' for w, row in zip(words, block)))
+
+    def close(self):
+        self.f.close()
+
+
+class TextWriter(object):
+    def __init__(self, path, num_rows, dim):
+        self.f = open(path, 'wb')
+        # the formatting needs ~300 bytes per value, format 2 ** 18 values at a time
+        self.rows = max(1, (1 << 18) // max(dim, 1))
+
+    def write(self, words, block):
+        for start in range(0, len(block), self.rows):
+            self.f.write(format_text(words[start:start + self.rows], block[start:start + self.rows]))
+
+    def close(self):
+        self.f.close()
+
+
+class _FromNumpy(object):
+    """Pickles as the tensor of a numpy array.
+
+    With pickle protocol 5 (Python 3.8+) the array data is written straight
+    from its buffer, so a memory-mapped array is not read into memory. Older
+    Pythons fall back to protocol 4, which copies it once.
+    """
+    def __init__(self, array):
+        self.array = array
+
+    def __reduce__(self):
+        return torch.from_numpy, (self.array,)
+
+
+class PickleWriter(NpyWriter):
+    """Collects the rows in a temporary .npy file and pickles them as a tensor on close."""
+    def __init__(self, path, num_rows, dim):
+        super(PickleWriter, self).__init__(path + '.tmp.npy', num_rows, dim)
+        self.pickle_path = path
+
+    def close(self):
+        super(PickleWriter, self).close()
+        # copy on write, so that it is pickled as a writable buffer
+        array = np.load(self.path, mmap_mode='c')
+        with open(self.pickle_path, 'wb') as f:
+            pickle.dump(_FromNumpy(array.view(np.ndarray)), f, protocol=pickle.HIGHEST_PROTOCOL)
+        del array
+        os.remove(self.path)
+
+
+WRITERS = {'npy': NpyWriter, 'bin': Word2VecWriter, 'txt': TextWriter, 'pkl': PickleWriter}
+
+
+def export_embeddings(path, words, rows, num_rows, dim, formats, block_size=4096):
+    """Writes a `num_rows` x `dim` embedding matrix in the given formats.
+
+    Args:
+        - path: file name without extension, every format adds its own
+        - words: the word of every row
+        - rows: function of `(start, end)` returning the rows `start:end` of
+          the matrix, e.g. projecting them, as a float32 array
+        - formats: list of names in `FORMATS`
+        - block_size: number of rows computed and written at a time
+    """
+    writers = [WRITERS[fmt]('{}.{}'.format(path, fmt), num_rows, dim) for fmt in formats]
+    try:
+        for start in range(0, num_rows, block_size):
+            end = min(start + block_size, num_rows)
+            block = rows(start, end)
+            for writer in writers:
+                writer.write(words[start:end], block)
+    finally:
+        for writer in writers:
+            writer.close()
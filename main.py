@@ -1,24 +1,30 @@
 # coding: utf-8
 import argparse
 import hashlib
+import json
 import math
 import os
 import numpy as np
 import random
+import sys
 import time
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.onnx
+from concurrent.futures import ThreadPoolExecutor
+from torch.nn.parallel import DistributedDataParallel
 import _pickle as pickle
 from tensorboardX import SummaryWriter
 
 import model
+from export import FORMATS, export_embeddings
+from data import BatchIterator, ExampleCorpus, RelationSampler, load_binary_iters
 
 import csv
 csv.field_size_limit(100000000)
 
-from random import shuffle
 from torchtext import data, datasets
 import torchtext
 import csv
@@ -99,18 +105,94 @@ parser.add_argument('--distance', type=str, default='cosine',
 parser.add_argument('--optim', type=str, default='sgd',
                     help='Type of optimizer to use. Options are [sgd, adagrad, adam]')
 parser.add_argument('--reg', action='store_true', help='Regularize.')
+parser.add_argument('--sparse_emb', action='store_true',
+                    help='Sparse gradients for the word embeddings, with --optim adam they are updated by SparseAdam.')
+parser.add_argument('--reg_interval', type=int, default=1,
+                    help='With --reg, add the orthogonality regularizer every this many steps, '
+                         'scaled by the interval.')
 parser.add_argument('--fixed_wn', action='store_true', help='Fixed WN proj matrices to identity matrix.')
 parser.add_argument('--random_wn', action='store_true', help='Fix random WN proj matrix and not learn it.')
 parser.add_argument('--lower', action='store_true', help='Lowercase for data.')
 parser.add_argument('--extend_wn', action='store_true', help='This flag allows the final embedding to be concatenation of wn embedding and lm embedding.')
 parser.add_argument('--nce', action='store_true', help='Use nce for training.')
 parser.add_argument('--nce_loss', type=str, default='nce', help='Type of nce to use.')
+parser.add_argument('--eval_memory', type=int, default=256,
+                    help='With --nce, compute the full softmax of evaluation in blocks of at most this many MB '
+                         'of scores (0 scores the whole vocabulary at once).')
+parser.add_argument('--noise_buffer', type=int, default=0,
+                    help='With --nce, draw noise samples this many at a time and slice them per step '
+                         '(0 draws every step).')
+parser.add_argument('--noise_sampler', type=str, default='unigram',
+                    help='With --nce, distribution of the noise samples. Options are [unigram, log_uniform]')
+parser.add_argument('--noise_power', type=float, default=1.,
+                    help='Power the unigram counts are raised to for --noise_sampler unigram.')
+parser.add_argument('--noise_ratio', type=int, default=0,
+                    help='With --nce, number of noise samples per target (0 uses a tenth of the vocab).')
+parser.add_argument('--score_memory', type=int, default=256,
+                    help='With --nce, score the noises of at most this many MB of scores at once and '
+                         'recompute them in backward (0 scores the whole batch at once).')
+parser.add_argument('--nce_mix', type=float, default=0.5,
+                    help='Weight of the NCE loss for --nce_loss mix, the sampled softmax loss gets the rest.')
 parser.add_argument('--num_neg_sample_subspace', type=int, default=10,
                     help='Number of negative samples to use while training lexical subspace.')
+parser.add_argument('--shared_negs', type=int, default=0,
+                    help='Share one pool of this many negatives between all relation pairs of a step '
+                         '(0 draws --num_neg_sample_subspace negatives per pair).')
+parser.add_argument('--neg_pool_size', type=int, default=0,
+                    help='Draw negative samples this many at a time and slice them per step (0 draws every step).')
 parser.add_argument('--max_vocab_size', type=int, default=None,
                     help='Vocab size to use for the dataset.')
+parser.add_argument('--loader_workers', type=int, default=0,
+                    help='Number of processes assembling batches in the background, kept for the whole run '
+                         'for every split (0 to build them in the training loop).')
+parser.add_argument('--prefetch', type=int, default=4,
+                    help='Number of batches prepared ahead by every loader worker.')
+parser.add_argument('--pairs_per_step', type=int, default=0,
+                    help='Sample this many pairs of every relation per step from the global pair tables, '
+                         'instead of using the pairs annotated with each batch (0).')
+parser.add_argument('--pair_dir', type=str, default=None,
+                    help='Directory with the syn/ant/hyp/mer_v<version>.txt pair tables (default: ./data/<data>). '
+                         'The version is --data_version, or 2 like the default of preprocessing/main.py.')
+parser.add_argument('--binary', action='store_true',
+                    help='Load the binary corpus written by preprocessing/main.py --binary.')
+parser.add_argument('--dist_backend', type=str, default='gloo',
+                    help='Backend of the process group when launched with torchrun.')
+parser.add_argument('--hogwild', type=int, default=0,
+                    help='For skipgram and cbow on CPU, train with this many processes updating the shared '
+                         'model without locks, with sparse embedding gradients (0 trains in this process).')
+parser.add_argument('--emb_formats', type=str, default='pkl,txt,npy',
+                    help='Comma separated formats of the saved embeddings. Options are [npy, bin, txt, pkl], '
+                         'bin is the word2vec binary format.')
+parser.add_argument('--export_threads', type=int, default=4,
+                    help='Number of embedding matrices written at the same time.')
 args = parser.parse_args()
 
+emb_formats = args.emb_formats.split(',')
+for fmt in emb_formats:
+    if fmt not in FORMATS:
+        raise ValueError('Unknown embedding format {}, options are {}'.format(fmt, FORMATS))
+
+# torchrun sets WORLD_SIZE, RANK and LOCAL_RANK for every process
+distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+rank = 0
+world_size = 1
+if distributed:
+    dist.init_process_group(args.dist_backend)
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    if args.cuda:
+        args.gpu = int(os.environ['LOCAL_RANK'])
+# only the first process logs and writes outputs
+is_master = rank == 0
+
+if args.hogwild:
+    if args.model not in ('skipgram', 'cbow'):
+        raise ValueError('--hogwild is only supported for --model skipgram and cbow')
+    if args.cuda or distributed:
+        raise ValueError('--hogwild trains on the CPU of a single machine, without --cuda or torchrun')
+    if args.optim == 'adam':
+        raise ValueError('--hogwild supports --optim sgd and adagrad, the Adam moments can not be shared')
+
 print(args)
 if args.random_seed is not None:
     random.seed(args.random_seed)
@@ -171,49 +253,75 @@ class Dataset(data.TabularDataset):
                  'meronyms_a': ('meronyms_a', WORDNET_TEXT_FIELD),
                  'meronyms_b': ('meronyms_b', WORDNET_TEXT_FIELD)
                 }
-        suffix = hashlib.md5('{}-{}-{}-{}-{}-lower_{}'.format(version, dataset_dir,
-                                                     train_file, valid_file, test_file, args.lower)
-                                            .encode()).hexdigest()
-
-        examples_path = os.path.join(dataset_dir, '{}.pkl'.format(suffix))
-
-        save_iters = False
-        if not load_from_file:
-            try:
-                examples = torch.load(examples_path)
-            except:
-                load_from_file = True
-                save_iters = True
-
+        relation_fields = ['synonyms', 'antonyms', 'hypernyms', 'meronyms']
+        if args.pairs_per_step > 0:
+            # relations are drawn by the RelationSampler, only the text is read
+            relation_fields = []
+            field_dict = {k: v for k, v in field_dict.items() if k in ('text', 'target')}
+
+        start_time = time.time()
+        files = [train_file or os.path.join(dataset_dir, 'train.txt'),
+                 valid_file or os.path.join(dataset_dir, 'valid.txt'),
+                 test_file or os.path.join(dataset_dir, 'test.txt')]
+        config = {'format': 2, 'version': version, 'lower': args.lower, 'max_vocab_size': args.max_vocab_size,
+                  'vectors': 'glove.6B.300d.txt' if args.model == 'retro' else None, 'fields': sorted(field_dict)}
+        cache_key = hashlib.md5(json.dumps(config, sort_keys=True).encode())
+        for path in files:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    cache_key.update(chunk)
+        cache_key = cache_key.hexdigest()
+
+        # the file name only depends on the location, the content hash is stored inside
+        suffix = hashlib.md5('{}-{}-{}-{}'.format(dataset_dir, *files).encode()).hexdigest()
+        cache_path = os.path.join(dataset_dir, 'cache_{}.pkl'.format(suffix))
+
+        cache = None
         if load_from_file:
-                print('Loading from file')
-                dataset = cls.splits(field_dict, dataset_dir, train_file, valid_file, test_file, **kwargs)
-                if save_iters:
-                    torch.save([d.examples for d in dataset], examples_path)
-
-        if not load_from_file:
-            dataset = [data.Dataset(ex, field_dict.values()) for ex in examples]
+            print('Example cache bypassed: {}'.format(cache_path))
+        elif not os.path.exists(cache_path):
+            print('Example cache miss: {}'.format(cache_path))
+        else:
+            try:
+                with open(cache_path, 'rb') as f:
+                    cache = pickle.load(f)
+            except (IOError, EOFError, ValueError, pickle.UnpicklingError) as e:
+                print('Example cache invalidated, unreadable ({}): {}'.format(e, cache_path))
+            else:
+                if cache.get('key') != cache_key:
+                    print('Example cache invalidated, data or field config changed: {}'.format(cache_path))
+                    cache = None
+                else:
+                    print('Example cache hit: {}'.format(cache_path))
 
-        train, valid, test = dataset
+        if cache is None:
+            print('Loading from file')
+            train, valid, test = cls.splits(field_dict, dataset_dir, train_file, valid_file, test_file, **kwargs)
 
-        if args.model == 'retro':
-            vec = torchtext.vocab.Vectors('glove.6B.300d.txt', cache='data/glove')
-            TEXT_FIELD.build_vocab(train, vectors=vec, max_size=args.max_vocab_size)
+            if args.model == 'retro':
+                vec = torchtext.vocab.Vectors('glove.6B.300d.txt', cache='data/glove')
+                TEXT_FIELD.build_vocab(train, vectors=vec, max_size=args.max_vocab_size)
+            else:
+                TEXT_FIELD.build_vocab(train, max_size=args.max_vocab_size)
+            vocab = TEXT_FIELD.vocab
+
+            splits = [ExampleCorpus.from_examples(d.examples, vocab, relation_fields) for d in (train, valid, test)]
+            cache = {'key': cache_key, 'vocab': vocab, 'splits': [s.state_dict() for s in splits]}
+            with open(cache_path + '.tmp', 'wb') as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_path + '.tmp', cache_path)
         else:
-            TEXT_FIELD.build_vocab(train, max_size=args.max_vocab_size)
-        WORDNET_TEXT_FIELD.vocab = TEXT_FIELD.vocab
+            vocab = cache['vocab']
+            splits = [ExampleCorpus.from_state_dict(s, vocab.itos) for s in cache['splits']]
+        train, valid, test = splits
 
-        if args.model == 'rnn':
-            train_iter, valid_iter, test_iter = data.Iterator.splits((train, valid, test),
-                                                    batch_size=batch_size, device=device,
-                                                    shuffle=False, repeat=False, sort=False)
-        else:
-            print('Using Bucket Iterator')
-            train_iter, valid_iter, test_iter = data.BucketIterator.splits((train, valid, test),
-                                                    batch_size=batch_size, device=device,
-                                                    shuffle=bool(args.model != 'rnn'), repeat=False, sort=False)
+        train_iter, valid_iter, test_iter = [BatchIterator(corpus, vocab, batch_size, device,
+                                                           shuffle=args.model != 'rnn' and corpus is train,
+                                                           num_workers=args.loader_workers, prefetch=args.prefetch)
+                                             for corpus in (train, valid, test)]
 
-        return train_iter, valid_iter, test_iter, TEXT_FIELD.vocab, TEXT_FIELD.vocab.vectors
+        print('Examples ready in {:.2f}s'.format(time.time() - start_time))
+        return train_iter, valid_iter, test_iter, vocab, vocab.vectors
 
 
 def dist_fn(x1, x2, dim=1):
@@ -232,19 +340,35 @@ if args.data_version:
 lex_rels = '_'.join(args.lex_rels) if len(args.lex_rels) > 0 else 'vanilla'
 summary_filename = os.path.join(args.save, 'logs_' + args.data + '_' + args.model + '_' + lex_rels + '_' + str(args.emsize) + '_' + str(args.nhid) + '_' + str(args.wn_hid) + '_' + args.distance)
 
-os.system('rm -rf ' + summary_filename)
-os.mkdir(summary_filename)
-writer = SummaryWriter(summary_filename)
+if is_master:
+    os.system('rm -rf ' + summary_filename)
+    os.mkdir(summary_filename)
+    writer = SummaryWriter(summary_filename)
+
+if args.binary:
+    vectors = torchtext.vocab.Vectors('glove.6B.300d.txt', cache='data/glove') if args.model == 'retro' else None
+    train_iter, valid_iter, test_iter, vocab, pretrained = load_binary_iters(os.path.join('./data', args.data, annotated_data_dir),
+                                                                             args.batch_size, device, lower=args.lower,
+                                                                             max_size=args.max_vocab_size, vectors=vectors,
+                                                                             shuffle=args.model != 'rnn',
+                                                                             num_workers=args.loader_workers,
+                                                                             prefetch=args.prefetch,
+                                                                             relations=args.pairs_per_step == 0)
+else:
+    train_iter, valid_iter, test_iter, vocab, pretrained = Dataset.iters(dataset_dir=os.path.join('./data', args.data, annotated_data_dir), device=device)
 
-train_iter, valid_iter, test_iter, vocab, pretrained = Dataset.iters(dataset_dir=os.path.join('./data', args.data, annotated_data_dir), device=device)
+if distributed:
+    # every process takes the same number of training steps, the evaluation
+    # losses are summed over the processes
+    train_iter.shard(world_size, rank, drop_last=True)
+    valid_iter.shard(world_size, rank)
+    test_iter.shard(world_size, rank)
 
 # This is the default WikiText2 iterator from TorchText.
 # Using this to compare our iterator. Will delete later.
 # train_iter, valid_iter, test_iter = datasets.WikiText2.iters(batch_size=args.batch_size, bptt_len=args.bptt,
 #                                                              device=device, root=args.data)
 # vocab = train_iter.dataset.fields['text'].vocab
-if args.model != 'rnn':
-    train_iter = [x for x in train_iter]
 
 # valid_iter = [x for x in valid_iter]
 # test_iter = [x for x in test_iter]
@@ -253,6 +377,14 @@ print('Loaded batches')
 ntokens = len(vocab)
 pad_idx = vocab.stoi['<pad>']
 
+relation_sampler = None
+eval_relation_sampler = None
+if args.pairs_per_step > 0:
+    relation_sampler = RelationSampler(args.pair_dir or os.path.join('./data', args.data), int(args.data_version or 2),
+                                       vocab, args.pairs_per_step, device, lower=args.lower, lex_rels=args.lex_rels)
+    # evaluation sees the same pairs on every call and leaves the training order alone
+    eval_relation_sampler = relation_sampler.seeded(args.torch_seed or 0)
+
 
 lr = args.lr
 best_val_loss = None
@@ -264,6 +396,19 @@ def repackage_hidden(h):
     else:
         return tuple(repackage_hidden(v) for v in h)
 
+
+def to_host(*values, sum_ranks=False):
+    """Running loss sums as floats, copied from the device with a single sync.
+
+    The sums are kept as device tensors (or plain 0. for unused losses) so
+    that the loops do not wait for the device on every step. With
+    `sum_ranks` they are summed over the processes of a distributed run.
+    """
+    values = torch.stack([torch.as_tensor(v, dtype=torch.float, device=device) for v in values])
+    if sum_ranks and distributed:
+        dist.all_reduce(values)
+    return values.tolist()
+
 cutoffs = [100, 1000, 5000] if args.data == 'wikitext-2' else [2800, 10000, 30000, 76000]
 
 idx2freq = [0] * ntokens
@@ -278,7 +423,11 @@ if args.model == 'rnn':
     lm_model = model.RNNModel(args.rnn_type, ntokens, em_dim, args.nhid, args.nlayers, idx2freq,
                               args.dropout, cutoffs=cutoffs, tie_weights=args.tied, adaptive=args.adaptive,
                               proj_lm=args.extend_wn, lm_dim=args.emsize,
-                              fixed=args.fixed_wn, random=args.random_wn, nce=args.nce, nce_loss=args.nce_loss).to(device)
+                              fixed=args.fixed_wn, random=args.random_wn, nce=args.nce, nce_loss=args.nce_loss,
+                              ce_memory=args.eval_memory << 20, noise_buffer=args.noise_buffer,
+                              noise_sampler=args.noise_sampler, noise_power=args.noise_power,
+                              noise_ratio=args.noise_ratio, score_memory=args.score_memory << 20,
+                              mix_weight=args.nce_mix).to(device)
     wn_model = model.WNModel(args.lex_rels, idx2freq, lm_model.encoder, em_dim, args.wn_hid, pad_idx,
                              wn_offset=wn_offset,
                              antonym_margin=args.margin,
@@ -287,7 +436,9 @@ if args.model == 'rnn':
                              random=args.random_wn,
                              dist_fn=dist_fn,
                              num_neg_samples=args.num_neg_sample_subspace,
-                             neg_wn_ratio=args.neg_wn_ratio).to(device)
+                             neg_wn_ratio=args.neg_wn_ratio,
+                             neg_pool_size=args.neg_pool_size,
+                             shared_negs=args.shared_negs).to(device)
     model = model.WNLM(lm_model, wn_model).to(device)
 elif args.model == 'retro':
     gl_model = model.GloveEncoderModel(ntokens, args.emsize, pretrained.to(device), dist_fn=dist_fn).to(device)
@@ -299,7 +450,9 @@ elif args.model == 'retro':
                              random=args.random_wn,
                              dist_fn=dist_fn,
                              num_neg_samples=args.num_neg_sample_subspace,
-                             neg_wn_ratio=args.neg_wn_ratio).to(device)
+                             neg_wn_ratio=args.neg_wn_ratio,
+                             neg_pool_size=args.neg_pool_size,
+                             shared_negs=args.shared_negs).to(device)
     model = model.GloveModel(gl_model, wn_model).to(device)
 elif args.model == 'cbow':
     wn_offset = args.emsize if args.extend_wn else 0
@@ -316,7 +469,9 @@ elif args.model == 'cbow':
                              random=args.random_wn,
                              dist_fn=dist_fn,
                              num_neg_samples=args.num_neg_sample_subspace,
-                             neg_wn_ratio=args.neg_wn_ratio).to(device)
+                             neg_wn_ratio=args.neg_wn_ratio,
+                             neg_pool_size=args.neg_pool_size,
+                             shared_negs=args.shared_negs).to(device)
 
     model = model.WNLM(lm_model, wn_model).to(device)
 elif args.model == 'skipgram':
@@ -325,7 +480,8 @@ elif args.model == 'skipgram':
 
     lm_model = model.SkipGramModel(ntokens, em_dim, idx2freq, cutoffs=cutoffs, adaptive=args.adaptive,
                               proj_lm=args.extend_wn, lm_dim=args.emsize,
-                              fixed=args.fixed_wn, random=args.random_wn, nce=args.nce, nce_loss=args.nce_loss).to(device)
+                              fixed=args.fixed_wn, random=args.random_wn, nce=args.nce, nce_loss=args.nce_loss,
+                              neg_pool_size=args.neg_pool_size).to(device)
     wn_model = model.WNModel(args.lex_rels, idx2freq, lm_model.encoder, em_dim, args.wn_hid, pad_idx,
                              wn_offset=wn_offset,
                              antonym_margin=args.margin,
@@ -334,7 +490,9 @@ elif args.model == 'skipgram':
                              random=args.random_wn,
                              dist_fn=dist_fn,
                              num_neg_samples=args.num_neg_sample_subspace,
-                             neg_wn_ratio=args.neg_wn_ratio).to(device)
+                             neg_wn_ratio=args.neg_wn_ratio,
+                             neg_pool_size=args.neg_pool_size,
+                             shared_negs=args.shared_negs).to(device)
 
     model = model.WNLM(lm_model, wn_model).to(device)
 else:
@@ -344,17 +502,54 @@ else:
 
 criterion = nn.NLLLoss()
 
-optimizer = torch.optim.Adagrad(model.parameters(), lr=lr) if args.optim == 'adagrad' \
-                else torch.optim.Adam(model.parameters(), lr=lr) if args.optim == 'adam' \
-                else torch.optim.SGD(model.parameters(), lr=lr)
+# embeddings only looked up by index, their gradients can be sparse
+sparse_params = []
+if args.sparse_emb or args.hogwild:
+    if args.tied:
+        raise ValueError('--sparse_emb can not be used with --tied, the decoder needs the dense gradient')
+    sparse_embs = [model.encoder] + ([model.lm.decoder] if args.model == 'skipgram' else [])
+    for emb in sparse_embs:
+        emb.sparse = True
+    sparse_params = [emb.weight for emb in sparse_embs]
+
+# SGD and Adagrad take sparse gradients, Adam needs SparseAdam for them
+sparse_optimizer = None
+if args.optim == 'adam' and sparse_params:
+    dense_params = [p for p in model.parameters() if all(p is not q for q in sparse_params)]
+    optimizer = torch.optim.Adam(dense_params, lr=lr)
+    sparse_optimizer = torch.optim.SparseAdam(sparse_params, lr=lr)
+else:
+    optimizer = torch.optim.Adagrad(model.parameters(), lr=lr) if args.optim == 'adagrad' \
+                    else torch.optim.Adam(model.parameters(), lr=lr) if args.optim == 'adam' \
+                    else torch.optim.SGD(model.parameters(), lr=lr)
+optimizers = [optimizer] + ([sparse_optimizer] if sparse_optimizer is not None else [])
 
 milestones=[100] if args.optim != 'sgd' else \
             ([3,6,7] if args.data == 'wikitext-103' else \
                 [10, 15, 25, 35]  if args.data == 'wikitext-2' else [2, 5, 10, 25])
 print(milestones)
-scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=milestones)
+schedulers = [torch.optim.lr_scheduler.MultiStepLR(opt, milestones=milestones) for opt in optimizers]
 # scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, 3)
 
+if args.hogwild:
+    # the workers update the parameters and the Adagrad sums in place, the
+    # gradients stay private to every worker
+    model.share_memory()
+    for opt in optimizers:
+        for state in opt.state.values():
+            for v in state.values():
+                if torch.is_tensor(v):
+                    v.share_memory_()
+
+train_model = model
+if distributed:
+    # averages the gradients over the processes in backward. The buffers are
+    # constant noise tables and per process noise pools, they are not synced.
+    train_model = DistributedDataParallel(model, broadcast_buffers=False, find_unused_parameters=True)
+    # the parameters were broadcast from the first process, the noise
+    # samples differ between processes
+    torch.manual_seed(args.torch_seed + rank)
+
 print('Lex Rel List: {}'.format(args.lex_rels))
 def evaluate(data_source):
     # Turn on evaluation mode which disables dropout.
@@ -371,16 +566,17 @@ def evaluate(data_source):
     if args.model != 'retro':
         hidden = model.init_hidden(args.batch_size)
 
+    if eval_relation_sampler is not None:
+        eval_relation_sampler.reset()
+
     start_time = time.time()
     with torch.no_grad():
         for i, batch in enumerate(data_source):
             data, targets = batch.text, batch.target
-            # synonyms, antonyms, hypernyms, meronyms = batch.synonyms, batch.antonyms, batch.hypernyms, batch.meronyms
-            synonyms_a, synonyms_b, antonyms_a, antonyms_b, hypernyms_a, hypernyms_b, meronyms_a, meronyms_b = batch.synonyms_a, batch.synonyms_b, batch.antonyms_a, batch.antonyms_b, batch.hypernyms_a, batch.hypernyms_b, batch.meronyms_a, batch.meronyms_b
-            synonyms = torch.stack((synonyms_a, synonyms_b), dim=2).view(-1, 2)
-            antonyms = torch.stack((antonyms_a, antonyms_b), dim=2).view(-1, 2)
-            hypernyms = torch.stack((hypernyms_a, hypernyms_b), dim=2).view(-1, 2)
-            meronyms = torch.stack((meronyms_a, meronyms_b), dim=2).view(-1, 2)
+            if eval_relation_sampler is not None:
+                synonyms, antonyms, hypernyms, meronyms = eval_relation_sampler.sample()
+            else:
+                synonyms, antonyms, hypernyms, meronyms = batch.synonyms, batch.antonyms, batch.hypernyms, batch.meronyms
 
             if args.model == 'retro':
                 output_dict = model(data, synonyms, antonyms, hypernyms, meronyms)
@@ -400,47 +596,21 @@ def evaluate(data_source):
             #     loss = output_dict['loss_ppl']
             total_loss += loss
             if 'syn' in args.lex_rels:
-                emb_syn1, emb_syn2 = output_dict['syn_emb']
-                syn_mask = 1 - (synonyms[:,0] == pad_idx).float()
-                syn_len = torch.sum(syn_mask)
-                loss_syn = output_dict.get('loss_syn',
-                                            torch.sum(dist_fn(emb_syn1, emb_syn2) * syn_mask)/syn_len)
-                total_loss_syn += loss_syn
-
-                emb_ant1, emb_ant2 = output_dict['ant_emb']
-                ant_mask = 1 - (antonyms[:,0] == pad_idx).float()
-                ant_len = torch.sum(ant_mask)
-                loss_ant = output_dict.get('loss_ant',
-                                            torch.sum(F.relu(args.margin - dist_fn(emb_ant1, emb_ant2)) * ant_mask)/ant_len)
-                total_loss_ant += loss_ant
+                total_loss_syn += output_dict['loss_syn']
+                total_loss_ant += output_dict['loss_ant']
 
             if 'hyp' in args.lex_rels:
-                if 'loss_hyp' in output_dict:
-                    loss_hyp = output_dict['loss_hyp']
-                else:
-                    emb_hyp1, emb_hyp2 = output_dict['hyp_emb']
-                    hyp_mask = 1 - (hypernyms[:,0] == pad_idx).float()
-                    hyp_len = torch.sum(hyp_mask)
-                    loss_hyp = torch.sum(dist_fn(emb_hyp1, emb_hyp2) * hyp_mask)/hyp_len
-
-                total_loss_hyp += loss_hyp
+                total_loss_hyp += output_dict['loss_hyp']
 
             if 'mer' in args.lex_rels:
-                if 'loss_mer' in output_dict:
-                    loss_mer = output_dict['loss_mer']
-                else:
-                    emb_mern1, emb_mern2 = output_dict['mer_emb']
-                    mer_mask = 1 - (meronyms[:,0] == pad_idx).float()
-                    mer_len = torch.sum(mer_mask)
-                    loss_mer = torch.sum(dist_fn(emb_mern1, emb_mern2) * mer_mask)/mer_len
-
-                total_loss_mern += loss_mer
+                total_loss_mern += output_dict['loss_mer']
 
     if args.model == 'rnn' and args.nce:
         model.lm.criterion.loss_type = args.nce_loss
 
-    return total_loss/(len(data_source) - 1), total_loss_syn/(len(data_source) - 1), total_loss_ant/(len(data_source) - 1), \
-            total_loss_hyp/ (len(data_source) - 1), total_loss_mern/(len(data_source) - 1)
+    *losses, num_batches = to_host(total_loss, total_loss_syn, total_loss_ant, total_loss_hyp, total_loss_mern,
+                                   len(data_source), sum_ranks=True)
+    return tuple(v / (num_batches - 1) for v in losses)
 
 
 def train(epoch):
@@ -456,40 +626,31 @@ def train(epoch):
     if args.model != 'retro':
         hidden = model.init_hidden(args.batch_size)
 
-    if args.model != 'rnn':
-        shuffle(train_iter)
-
+    # time spent waiting for the next batch
+    data_time = 0.
+    batch_start = time.time()
     for idx, batch in enumerate(train_iter):
+        data_time += time.time() - batch_start
         data, targets = batch.text, batch.target
-        # synonyms, antonyms, hypernyms, meronyms = batch.synonyms, batch.antonyms, batch.hypernyms, batch.meronyms
-        synonyms_a, synonyms_b, antonyms_a, antonyms_b, hypernyms_a, hypernyms_b, meronyms_a, meronyms_b = batch.synonyms_a, batch.synonyms_b, batch.antonyms_a, batch.antonyms_b, batch.hypernyms_a, batch.hypernyms_b, batch.meronyms_a, batch.meronyms_b
-        synonyms = torch.stack((synonyms_a, synonyms_b), dim=2).view(-1, 2)
-        antonyms = torch.stack((antonyms_a, antonyms_b), dim=2).view(-1, 2)
-        hypernyms = torch.stack((hypernyms_a, hypernyms_b), dim=2).view(-1, 2)
-        meronyms = torch.stack((meronyms_a, meronyms_b), dim=2).view(-1, 2)
-
-        syn_non_pad_idxs = (1 - (synonyms[:,0] == pad_idx).int()).nonzero().squeeze(1) 
-        ant_non_pad_idxs = (1 - (antonyms[:,0] == pad_idx).int()).nonzero().squeeze(1) 
-        hyp_non_pad_idxs = (1 - (hypernyms[:,0] == pad_idx).int()).nonzero().squeeze(1) 
-        mer_non_pad_idxs = (1 - (meronyms[:,0] == pad_idx).int()).nonzero().squeeze(1) 
-
-        synonyms = synonyms[syn_non_pad_idxs]
-        antonyms = antonyms[ant_non_pad_idxs]
-        hypernyms = hypernyms[hyp_non_pad_idxs]
-        meronyms = meronyms[mer_non_pad_idxs]
-
-        optimizer.zero_grad()
+        if relation_sampler is not None:
+            synonyms, antonyms, hypernyms, meronyms = relation_sampler.sample()
+        else:
+            # the relation pairs come without padding from the batch iterator
+            synonyms, antonyms, hypernyms, meronyms = batch.synonyms, batch.antonyms, batch.hypernyms, batch.meronyms
+
+        for opt in optimizers:
+            opt.zero_grad()
         syn_ratio = args.syn_ratio
         hyp_ratio = args.hyp_ratio
         mer_ratio = args.mer_ratio
 
         if args.model == 'retro':
-            output_dict = model(data, synonyms, antonyms, hypernyms, meronyms)
+            output_dict = train_model(data, synonyms, antonyms, hypernyms, meronyms)
             emb, emb_glove = output_dict['glove_emb']
             loss = output_dict.get('glove_loss',
                                     torch.mean(dist_fn(emb, emb_glove)))
         else:
-            output_dict = model(data, hidden, targets, synonyms, antonyms, hypernyms, meronyms)
+            output_dict = train_model(data, hidden, targets, synonyms, antonyms, hypernyms, meronyms)
 
             output, hidden = output_dict['log_probs'], output_dict['hidden_vec']
             hidden = repackage_hidden(hidden)
@@ -499,111 +660,140 @@ def train(epoch):
             else:
                 loss = criterion(output.view(-1, ntokens), targets.view(-1))
 
+        # not in place, `loss` is logged on its own
         total_loss = loss
 
-
+        # the running sums stay on the device until the next log
         if 'syn' in args.lex_rels:
-            emb_syn1, emb_syn2 = output_dict['syn_emb']
-            syn_mask = 1 - (synonyms[:,0] == pad_idx).float()
-            syn_len = torch.sum(syn_mask)
-            loss_syn = output_dict.get('loss_syn',
-                                        torch.sum(dist_fn(emb_syn1, emb_syn2) * syn_mask)/syn_len)
-
-            emb_ant1, emb_ant2 = output_dict['ant_emb']
-            ant_mask = 1 - (antonyms[:,0] == pad_idx).float()
-            ant_len = torch.sum(ant_mask)
-            loss_ant = output_dict.get('loss_ant',
-                                        torch.sum(F.relu(args.margin - dist_fn(emb_ant1, emb_ant2)) * ant_mask)/ant_len)
-
-            total_loss += syn_ratio * (loss_syn + loss_ant)
-            total_loss_syn += loss_syn.item()
-            total_loss_ant += loss_ant.item()
+            loss_syn = output_dict['loss_syn']
+            loss_ant = output_dict['loss_ant']
+
+            total_loss = total_loss + syn_ratio * (loss_syn + loss_ant)
+            total_loss_syn += loss_syn.detach()
+            total_loss_ant += loss_ant.detach()
 
         if 'hyp' in args.lex_rels:
-            if 'loss_hyp' in output_dict:
-                loss_hyp = output_dict['loss_hyp']
-            else:
-                emb_hyp1, emb_hyp2 = output_dict['hyp_emb']
-                hyp_mask = 1 - (hypernyms[:,0] == pad_idx).float()
-                hyp_len = torch.sum(hyp_mask)
-                loss_hyp = torch.sum(dist_fn(emb_hyp1, emb_hyp2) * hyp_mask)/hyp_len
+            loss_hyp = output_dict['loss_hyp']
 
-            total_loss += hyp_ratio * loss_hyp
-            total_loss_hyp += loss_hyp.item()
+            total_loss = total_loss + hyp_ratio * loss_hyp
+            total_loss_hyp += loss_hyp.detach()
 
         if 'mer' in args.lex_rels:
-            if 'loss_mer' in output_dict:
-                loss_mer = output_dict['loss_mer']
-            else:
-                emb_mern1, emb_mern2 = output_dict['mer_emb']
-                mer_mask = 1 - (meronyms[:,0] == pad_idx).float()
-                mer_len = torch.sum(mer_mask)
-                loss_mer = torch.sum(dist_fn(emb_mern1, emb_mern2) * mer_mask)/mer_len
+            loss_mer = output_dict['loss_mer']
 
-            total_loss += mer_ratio * loss_mer
-            total_loss_mern += loss_mer.item()
+            total_loss = total_loss + mer_ratio * loss_mer
+            total_loss_mern += loss_mer.detach()
 
-        if args.reg:
-            reg_loss = output_dict.get('reg_loss', 0)
-            total_loss_reg = reg_loss
-            total_loss += reg_loss
+        if args.reg and idx % args.reg_interval == 0:
+            # only depends on the parameters, so it is not part of the forward
+            reg_loss = model.reg_loss()
+            total_loss = total_loss + args.reg_interval * reg_loss
+            total_loss_reg += reg_loss.detach() if torch.is_tensor(reg_loss) else reg_loss
 
         total_loss.backward()
 
+        # merge the rows looked up more than once, so that clipping and the
+        # optimizers work on the active rows only once
+        for p in sparse_params:
+            if p.grad is not None:
+                p.grad = p.grad.coalesce()
         # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
         torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
-        optimizer.step()
+        for opt in optimizers:
+            opt.step()
         # if args.model == 'skipgram':
         #     loss = output_dict['loss_ppl']
-        total_loss_ += loss.item()
+        total_loss_ += loss.detach()
 
         if idx % args.log_interval == 0 and idx > 0:
-            cur_loss = total_loss_ / args.log_interval
-            curr_syn_loss = total_loss_syn / args.log_interval
-            curr_ant_loss = total_loss_ant / args.log_interval
-            curr_hyp_loss = total_loss_hyp / args.log_interval
-            curr_mern_loss = total_loss_mern / args.log_interval
-            curr_reg_loss = total_loss_reg / args.log_interval
-
-            elapsed = time.time() - start_time
-            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.10f} | ms/batch {:5.2f} | loss {:5.2f} | ppl {:8.2f} | syn loss {:5.2f} | ant loss {:5.2f} | hyp loss {:5.2f} | mer loss {:5.2f} | reg_loss {:5.2f}'
-                    .format(epoch, idx, len(train_iter), optimizer.param_groups[0]['lr'], elapsed * 1000 / args.log_interval,
-                        cur_loss, math.exp(min(cur_loss, 10)), curr_syn_loss, curr_ant_loss, curr_hyp_loss, curr_mern_loss, curr_reg_loss))
-            global_step = epoch*args.batch_size + idx
-            writer.add_scalar('Train/LMLoss', cur_loss, global_step)
-            writer.add_scalar('Train/SynLoss', curr_syn_loss, global_step)
-            writer.add_scalar('Train/AntLoss', curr_ant_loss, global_step)
-            writer.add_scalar('Train/HypLoss', curr_hyp_loss, global_step)
-            writer.add_scalar('Train/MernLoss', curr_mern_loss, global_step)
-
-            writer.add_scalar('Train/lr', optimizer.param_groups[0]['lr'], global_step)
+            if is_master:
+                cur_loss, curr_syn_loss, curr_ant_loss, curr_hyp_loss, curr_mern_loss, curr_reg_loss = to_host(
+                    total_loss_, total_loss_syn, total_loss_ant, total_loss_hyp, total_loss_mern, total_loss_reg)
+                cur_loss /= args.log_interval
+                curr_syn_loss /= args.log_interval
+                curr_ant_loss /= args.log_interval
+                curr_hyp_loss /= args.log_interval
+                curr_mern_loss /= args.log_interval
+                curr_reg_loss /= max(args.log_interval // args.reg_interval, 1)
+
+                elapsed = time.time() - start_time
+                print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.10f} | ms/batch {:5.2f} | data ms/batch {:5.2f} | loss {:5.2f} | ppl {:8.2f} | syn loss {:5.2f} | ant loss {:5.2f} | hyp loss {:5.2f} | mer loss {:5.2f} | reg_loss {:5.2f}'
+                        .format(epoch, idx, len(train_iter), optimizer.param_groups[0]['lr'], elapsed * 1000 / args.log_interval,
+                            data_time * 1000 / args.log_interval,
+                            cur_loss, math.exp(min(cur_loss, 10)), curr_syn_loss, curr_ant_loss, curr_hyp_loss, curr_mern_loss, curr_reg_loss))
+                global_step = epoch*args.batch_size + idx
+                writer.add_scalar('Train/LMLoss', cur_loss, global_step)
+                writer.add_scalar('Train/SynLoss', curr_syn_loss, global_step)
+                writer.add_scalar('Train/AntLoss', curr_ant_loss, global_step)
+                writer.add_scalar('Train/HypLoss', curr_hyp_loss, global_step)
+                writer.add_scalar('Train/MernLoss', curr_mern_loss, global_step)
+
+                writer.add_scalar('Train/lr', optimizer.param_groups[0]['lr'], global_step)
 
             start_time = time.time()
-            total_loss_ = 0
-            total_loss_syn = 0
-            total_loss_ant = 0
-            total_loss_hyp = 0
-            total_loss_mern = 0
+            total_loss_ = 0.
+            total_loss_syn = 0.
+            total_loss_ant = 0.
+            total_loss_hyp = 0.
+            total_loss_mern = 0.
+            total_loss_reg = 0.
+            data_time = 0.
+
+        batch_start = time.time()
 
     print()
 
+
+def hogwild_worker(epoch, worker):
+    global is_master, writer
+    # all workers shuffle the same way, so their shards are disjoint
+    np.random.seed(args.numpy_seed + epoch)
+    torch.manual_seed(args.torch_seed + epoch * args.hogwild + worker)
+    torch.set_num_threads(1)
+    train_iter.shard(args.hogwild, worker)
+    # the writer thread of the parent does not survive the fork
+    is_master = worker == 0
+    if is_master:
+        writer = SummaryWriter(summary_filename)
+    train(epoch)
+    if is_master:
+        writer.close()
+
+
+def train_hogwild(epoch):
+    """Runs `train` in `args.hogwild` forked processes, each on a shard of the epoch.
+
+    The processes update the shared model without any locking, their sparse
+    updates rarely touch the same rows.
+    """
+    ctx = torch.multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=hogwild_worker, args=(epoch, i)) for i in range(args.hogwild)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    if any(w.exitcode != 0 for w in workers):
+        raise RuntimeError('Hogwild workers failed with exit codes {}'.format([w.exitcode for w in workers]))
+
 patience = 0
 
 model_name = os.path.join(args.save, 'model_' + args.data + '_' + args.model + '_' + lex_rels + '_' + str(args.emsize) + '_' + str(args.nhid) + '_' + str(args.wn_hid) + '_' + args.distance + ('_wn_v{}'.format(args.data_version) if args.data_version else '') + '.pt')
-emb_name = os.path.join(args.save_emb, 'emb_' + args.data + '_' + args.model + '_' + lex_rels + '_' + str(args.emsize) + '_' + str(args.nhid) + '_' + str(args.wn_hid) + '_' + args.distance + ('_wn_v{}'.format(args.data_version) if args.data_version else '') + '.pkl')
-emb_name_txt = os.path.join(args.save_emb, 'emb_' + args.data + '_' + args.model + '_' + lex_rels + '_' + str(args.emsize) + '_' + str(args.nhid) + '_' + str(args.wn_hid) + '_' + args.distance + ('_wn_v{}'.format(args.data_version) if args.data_version else '') + '.txt')
+emb_name = os.path.join(args.save_emb, 'emb_' + args.data + '_' + args.model + '_' + lex_rels + '_' + str(args.emsize) + '_' + str(args.nhid) + '_' + str(args.wn_hid) + '_' + args.distance + ('_wn_v{}'.format(args.data_version) if args.data_version else ''))
 
-rel_emb_name_temp = os.path.join(args.save_emb, 'emb_%s_' + args.data + '_' + args.model + '_' + lex_rels + '_' + str(args.emsize) + '_' + str(args.nhid) + '_' + str(args.wn_hid) + '_' + args.distance + ('_wn_v{}'.format(args.data_version) if args.data_version else '') + '.pkl')
-rel_emb_name_temp_txt = os.path.join(args.save_emb, 'emb_%s_' + args.data + '_' + args.model + '_' + lex_rels + '_' + str(args.emsize) + '_' + str(args.nhid) + '_' + str(args.wn_hid) + '_' + args.distance + ('_wn_v{}'.format(args.data_version) if args.data_version else '') + '.txt')
+rel_emb_name_temp = os.path.join(args.save_emb, 'emb_%s_' + args.data + '_' + args.model + '_' + lex_rels + '_' + str(args.emsize) + '_' + str(args.nhid) + '_' + str(args.wn_hid) + '_' + args.distance + ('_wn_v{}'.format(args.data_version) if args.data_version else ''))
 
 vocab_name = os.path.join(args.save, 'vocab_' + args.data + '.pkl')
-pickle.dump(vocab, open(vocab_name, 'wb'))
-print('Vocab Saved')
+if is_master:
+    pickle.dump(vocab, open(vocab_name, 'wb'))
+    print('Vocab Saved')
 
 try:
     for epoch in range(1, args.epochs+1):
         epoch_start_time = time.time()
-        train(epoch)
+        if args.hogwild:
+            train_hogwild(epoch)
+        else:
+            train(epoch)
 
         if args.model != 'retro':
             val_loss, loss_syn, loss_ant, loss_hyp, loss_mer = evaluate(valid_iter)
@@ -614,17 +804,20 @@ try:
             print('-' * 89)
             # Save the model if the validation loss is the best we've seen so far.
             if not best_val_loss or val_loss < best_val_loss:
-                with open(model_name, 'wb') as f:
-                    torch.save(model, f)
+                if is_master:
+                    with open(model_name, 'wb') as f:
+                        torch.save(model, f)
 
                 best_val_loss = val_loss
                 patience = 0
             else:
                 patience += 1
-            scheduler.step()
+            # every process steps them once per epoch, so the learning rates stay in sync
+            for scheduler in schedulers:
+                scheduler.step()
             if False and patience > 3:
                 break
-        elif epoch % 10 == 0:
+        elif epoch % 10 == 0 and is_master:
             print('Saving Model')
             with open(model_name, 'wb') as f:
                 torch.save(model, f)
@@ -634,6 +827,9 @@ except KeyboardInterrupt:
     print('Exiting from training early')
 
 # Load the best saved model.
+if distributed:
+    # wait for the first process to write it
+    dist.barrier()
 if args.model != 'retro':
     with open(model_name, 'rb') as f:
         model = torch.load(f)
@@ -651,71 +847,40 @@ if args.model != 'retro':
         test_loss, math.exp(test_loss), test_syn, test_ant, test_hyp, test_mer))
     print('=' * 89)
 
-print('Saving final learnt embeddings ')
-with open(emb_name, 'wb') as f:
-    pickle.dump(model.encoder.weight.data, f)
-
-with open(emb_name_txt, 'w') as f:
-    final_emb = model.encoder.weight.data.cpu().numpy()
-    for i in range(final_emb.shape[0]):
-        f.write(vocab.itos[i] + ' ')
-        f.write(' '.join([str(x) for x in final_emb[i, :]]) + '\n')
-
+if distributed:
+    dist.destroy_process_group()
+    if not is_master:
+        sys.exit(0)
+
+def projected(*layers):
+    """Rows of the word embeddings passed through `layers`, computed one block at a time."""
+    def rows(start, end):
+        with torch.no_grad():
+            emb = model.encoder.weight[start:end]
+            for layer in layers:
+                emb = layer(emb)
+            return emb.float().cpu().numpy()
+    return rows
+
+# (file name, rows) of every embedding matrix, e.g. emb_syn_... with the
+# synonym subspace. Their rows are projected block by block as they are written.
+exports = [(emb_name, projected())]
 for rel in args.lex_rels:
-    rel_emb_name = rel_emb_name_temp % rel
-    rel_emb_name_txt = rel_emb_name_temp_txt % rel
-    print('Saving lexical subspace embeddings : %s' % rel)
-
     if rel == 'syn':
-        syn_emb = model.wn.syn_proj(model.wn.embedding.weight)
-        with open(rel_emb_name, 'wb') as f:
-            pickle.dump(syn_emb.data, f)
-
-        syn_emb_np = syn_emb.data.cpu().numpy()
-        with open(rel_emb_name_txt, 'w') as f:
-            for i in range(syn_emb_np.shape[0]):
-                f.write(vocab.itos[i] + ' ')
-                f.write(' '.join([str(x) for x in syn_emb_np[i, :]]) + '\n')
-
+        exports.append((rel_emb_name_temp % 'syn', projected(model.wn.syn_proj)))
     elif rel == 'hyp':
-        hypernyms_emb = model.wn.hypn_proj(model.wn.embedding.weight)
-
-        with open(rel_emb_name_temp % ('hypn_hypernyms'), 'wb') as f:
-            pickle.dump(hypernyms_emb.data, f)
-        
-        hypernyms_emb_np = hypernyms_emb.data.cpu().numpy()
-        with open(rel_emb_name_temp_txt % ('hypn_hypernyms'), 'w') as f:
-            for i in range(hypernyms_emb_np.shape[0]):
-                f.write(vocab.itos[i] + ' ')
-                f.write(' '.join([str(x) for x in hypernyms_emb_np[i, :]]) + '\n')
-
-        hyponyms_emb = model.wn.hypn_rel(hypernyms_emb)
-        with open(rel_emb_name_temp % ('hypn_hyponyms'), 'wb') as f:
-            pickle.dump(hyponyms_emb.data, f)
-
-        hyponyms_emb_np = hyponyms_emb.data.cpu().numpy()
-        with open(rel_emb_name_temp_txt % ('hypn_hyponyms'), 'w') as f:
-            for i in range(hyponyms_emb_np.shape[0]):
-                f.write(vocab.itos[i] + ' ')
-                f.write(' '.join([str(x) for x in hyponyms_emb_np[i, :]]) + '\n')
-
+        exports.append((rel_emb_name_temp % 'hypn_hypernyms', projected(model.wn.hypn_proj)))
+        exports.append((rel_emb_name_temp % 'hypn_hyponyms', projected(model.wn.hypn_proj, model.wn.hypn_rel)))
     elif rel == 'mer':
-        meronyms_emb = model.wn.mern_proj(model.wn.embedding.weight)
-        with open(rel_emb_name_temp % ('mern_meronyms'), 'wb') as f:
-            pickle.dump(meronyms_emb.data, f)
-
-        meronyms_emb_np = meronyms_emb.data.cpu().numpy()
-        with open(rel_emb_name_temp_txt % ('mern_meronyms'), 'w') as f:
-            for i in range(meronyms_emb_np.shape[0]):
-                f.write(vocab.itos[i] + ' ')
-                f.write(' '.join([str(x) for x in meronyms_emb_np[i, :]]) + '\n')
-
-        holonyms_emb = model.wn.mern_rel(meronyms_emb)
-        with open(rel_emb_name_temp % ('mern_holonyms'), 'wb') as f:
-            pickle.dump(holonyms_emb.data, f)
-
-        holonyms_emb_np = holonyms_emb.data.cpu().numpy()
-        with open(rel_emb_name_temp_txt % ('mern_holonyms'), 'w') as f:
-            for i in range(holonyms_emb_np.shape[0]):
-                f.write(vocab.itos[i] + ' ')
-                f.write(' '.join([str(x) for x in holonyms_emb_np[i, :]]) + '\n')
+        exports.append((rel_emb_name_temp % 'mern_meronyms', projected(model.wn.mern_proj)))
+        exports.append((rel_emb_name_temp % 'mern_holonyms', projected(model.wn.mern_proj, model.wn.mern_rel)))
+
+print('Saving final learnt and lexical subspace embeddings as {}'.format(', '.join(emb_formats)))
+model.eval()
+with ThreadPoolExecutor(max_workers=args.export_threads) as pool:
+    jobs = [pool.submit(export_embeddings, name, vocab.itos, rows, ntokens, rows(0, 1).shape[1], emb_formats)
+            for name, rows in exports]
+    for (name, _), job in zip(exports, jobs):
+        # raises the error of a failed export
+        job.result()
+        print('Saved {}'.format(name))
@@ -2,9 +2,24 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch
 
-from nce import IndexLinear
+from nce import IndexLinear, build_sampler
+from nce.alias_multinomial import AliasMultinomial
 from torchqrnn import QRNN
 
+
+def orthogonality_loss(projections):
+    """Sum of the squared entries of W_i W_j^T over every pair of projections.
+
+    Pushes the lexical subspaces to be orthogonal. It only depends on the
+    parameters, so the training loop adds it once per step (see `--reg`)
+    instead of every forward computing it.
+    """
+    loss = 0.
+    for i in range(len(projections)):
+        for j in range(i + 1, len(projections)):
+            loss = loss + torch.sum(torch.pow(torch.mm(projections[i].weight, projections[j].weight.t()), 2))
+    return loss
+
 class RNNWordnetModel(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
 
@@ -60,6 +75,9 @@ class RNNWordnetModel(nn.Module):
             self.decoder.bias.data.zero_()
             self.decoder.weight.data.uniform_(-initrange, initrange)
 
+    def reg_loss(self):
+        return orthogonality_loss([self.syn_proj, self.hypn_proj, self.mern_proj])
+
     def forward(self, input, hidden, target, synonym, antonym, hypernym, meronym):
         emb = self.drop(self.encoder(input))
         emb_syn1 = self.syn_proj(self.encoder(synonym[:, 0]))
@@ -84,14 +102,6 @@ class RNNWordnetModel(nn.Module):
             decoded = F.log_softmax(self.decoder(output.view(output.size(0)*output.size(1), output.size(2))), dim=-1)
         decoded = decoded.view(output.size(0), output.size(1), decoded.size(1))
 
-        eye = torch.eye(self.wn_hid, device=self.syn_proj.weight.device)
-        reg_loss =  torch.sum(\
-                             torch.pow(torch.mm(self.syn_proj.weight, self.hypn_proj.weight.t()), 2) + \
-                             torch.pow(torch.mm(self.syn_proj.weight, self.mern_proj.weight.t()), 2) + \
-                             torch.pow(torch.mm(self.hypn_proj.weight, self.mern_proj.weight.t()), 2)) # + \
-                             # torch.pow(torch.sum(self.syn_proj.weight**2) - 1, 2) + \
-                             # torch.pow(torch.sum(self.hypn_proj.weight**2) - 1, 2) + \
-                             # torch.pow(torch.sum(self.mern_proj.weight**2) - 1, 2)
         output_dict = {
                 'log_probs': decoded,
                 'hidden_vec': hidden,
@@ -99,7 +109,6 @@ class RNNWordnetModel(nn.Module):
                 'ant_emb': (emb_ant1, emb_ant2),
                 'hyp_emb': (emb_hypn1, emb_hypn2),
                 'mer_emb': (emb_mern1, emb_mern2),
-                'loss_reg': reg_loss
             }
         return output_dict
 
@@ -117,7 +126,9 @@ class RNNModel(nn.Module):
 
     def __init__(self, rnn_type, ntoken, ninp, nhid, nlayers, vocab_freq,
                     dropout=0.5, cutoffs=[1000, 10000], tie_weights=False, adaptive=False,
-                    proj_lm=False, lm_dim=None, fixed=False, random=False, nce=False, nce_loss='nce'):
+                    proj_lm=False, lm_dim=None, fixed=False, random=False, nce=False, nce_loss='nce',
+                    ce_memory=0, noise_buffer=0, noise_sampler='unigram', noise_power=1., noise_ratio=0,
+                    score_memory=0, mix_weight=0.5):
         super(RNNModel, self).__init__()
         self.drop = nn.Dropout(dropout)
         self.encoder = nn.Embedding(ntoken, ninp)
@@ -151,23 +162,16 @@ class RNNModel(nn.Module):
             self.decoder.weight = self.encoder.weight
 
         if nce:
-            def build_unigram_noise(freq):
-                """build the unigram noise from a list of frequency
-                Parameters:
-                    freq: a tensor of #occurrences of the corresponding index
-                Return:
-                    unigram_noise: a torch.Tensor with size ntokens,
-                    elements indicate the probability distribution
-                """
-                total = freq.sum()
-                noise = freq / total
-                assert abs(noise.sum() - 1) < 0.001
-                return noise
-
+            noise, sampler = build_sampler(noise_sampler, vocab_freq, noise_power)
             self.criterion = IndexLinear(nhid, ntoken,
-                                noise=build_unigram_noise(vocab_freq),
-                                noise_ratio=int(ntoken/10),
-                                loss_type=nce_loss)
+                                noise=noise,
+                                noise_ratio=noise_ratio or int(ntoken/10),
+                                loss_type=nce_loss,
+                                ce_memory=ce_memory,
+                                noise_buffer=noise_buffer,
+                                sampler=sampler,
+                                score_memory=score_memory,
+                                mix_weight=mix_weight)
         else:
             if adaptive:
                 self.adaptive_softmax = nn.AdaptiveLogSoftmaxWithLoss(nhid, ntoken, cutoffs=cutoffs)
@@ -221,7 +225,8 @@ class RNNModel(nn.Module):
         output_dict['hidden_vec'] = hidden
         output_dict['log_probs'] = None
         if targets is not None and self.nce:
-            output_dict['loss_lm'] = self.criterion(targets.view(-1, 1), output.unsqueeze(1))
+            # one row per target, so that the criterion can score them in tiles
+            output_dict['loss_lm'] = self.criterion(targets.view(-1, 1), output.view(-1, 1, output.size(2)))
         else:
             if self.adaptive:
                 decoded = self.adaptive_softmax.log_prob(output.view(output.size(0)*output.size(1), output.size(2)))
@@ -326,7 +331,7 @@ class SkipGramModel(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
 
     def __init__(self, ntoken, ninp, vocab_freq, cutoffs=[1000, 10000], adaptive=False,
-                proj_lm=False, lm_dim=None, fixed=False, random=False, nce=False, nce_loss='nce'):
+                proj_lm=False, lm_dim=None, fixed=False, random=False, nce=False, nce_loss='nce', neg_pool_size=0):
         super(SkipGramModel, self).__init__()
         self.encoder = nn.Embedding(ntoken, ninp)
         self.decoder = nn.Embedding(ntoken, ninp)
@@ -334,7 +339,7 @@ class SkipGramModel(nn.Module):
         self.weights = vocab_freq / vocab_freq.sum()
         self.weights = self.weights.pow(0.75)
         self.weights = self.weights/self.weights.sum()
-        self.weights = self.weights.cuda()
+        self.sampler = AliasMultinomial(self.weights, pool_size=neg_pool_size)
 
 
         # if not proj_lm or lm_dim is None:
@@ -410,7 +415,7 @@ class SkipGramModel(nn.Module):
             context_size = 8
 
         emb_input = self.encoder(input).view(batch_size, emb_dim, -1)
-        nwords = torch.multinomial(self.weights, batch_size * context_size * n_negs, replacement=True).view(batch_size, -1)
+        nwords = self.sampler.draw(batch_size, context_size * n_negs)
         emb_output = self.decoder(targets).view(batch_size, context_size, -1)
         emb_nwords = self.decoder(nwords).view(batch_size, context_size*n_negs, -1).neg()
         # print(emb_input.shape)
@@ -453,7 +458,7 @@ class GloveEncoderModel(nn.Module):
         return output_dict
 
 class WNModel(nn.Module):
-    def __init__(self, lex_rels, vocab_freq, embedding, emb_dim, wn_dim, pad_idx, wn_offset=0, antonym_margin=1, n_margin=1, dist_fn=F.pairwise_distance, fixed=False, random=False, num_neg_samples=10, common_vs=False, neg_wn_ratio=10):
+    def __init__(self, lex_rels, vocab_freq, embedding, emb_dim, wn_dim, pad_idx, wn_offset=0, antonym_margin=1, n_margin=1, dist_fn=F.pairwise_distance, fixed=False, random=False, num_neg_samples=10, common_vs=False, neg_wn_ratio=10, neg_pool_size=0, shared_negs=0):
         super(WNModel, self).__init__()
 
         if common_vs:
@@ -471,7 +476,11 @@ class WNModel(nn.Module):
         self.weights = vocab_freq / vocab_freq.sum()
         self.weights = self.weights.pow(0.75)
         self.weights = self.weights/self.weights.sum()
+        self.sampler = AliasMultinomial(self.weights, pool_size=neg_pool_size)
         self.n_negs = num_neg_samples
+        # if > 0, size of a pool of negatives shared by all pairs of a step
+        # instead of n_negs negatives per pair
+        self.shared_negs = shared_negs
         self.neg_wn_ratio = neg_wn_ratio
 
         if 'syn' in lex_rels:
@@ -520,85 +529,106 @@ class WNModel(nn.Module):
                 for param in self.mern_proj.parameters():
                     param.requires_grad = False
 
+        # name of the projection of every relation, antonyms share the synonym one
+        self.proj_of = {rel: name for rel, name in [('syn', 'syn_proj'), ('ant', 'syn_proj'),
+                                                    ('hyp', 'hypn_proj'), ('mer', 'mern_proj')]
+                        if ('syn' if rel == 'ant' else rel) in lex_rels}
+
         self.dist_fn = dist_fn
 
-    def forward(self, synonyms=None, antonyms=None, hypernyms=None, meronyms=None):
-        def mask(lex_rel):
-            return 1 - (lex_rel[:,0] == self.pad_idx).float()
-            
-        output_dict = {}
-        if 'syn' in self.lex_rels and synonyms is not None:
-            batch_size = synonyms.size(0)
-            syn_mask = mask(synonyms)
-            syn_len = torch.sum(syn_mask)
-
-            emb_syn1 = self.syn_proj(self.embedding(synonyms[:, 0]))
-            emb_syn2 = self.syn_proj(self.embedding(synonyms[:, 1]))
-            nwords = torch.multinomial(self.weights, batch_size * self.n_negs, replacement=True).view(batch_size, -1).cuda()
-            emb_syn_neg = self.syn_proj(self.embedding(nwords.view(batch_size, self.n_negs)).view(-1, self.emb_dim)).view(batch_size, self.n_negs, -1)
-
-            output_dict['loss_syn'] = torch.sum((self.dist_fn(emb_syn1, emb_syn2) \
-                                        + self.neg_wn_ratio * F.relu(self.n_margin - self.dist_fn(emb_syn1.view(batch_size, 1, -1), emb_syn_neg, dim=2)).mean(1) \
-                                        # + self.neg_wn_ratio * F.relu(self.dist_fn(emb_syn1.view(batch_size, 1, -1), emb_syn_neg, dim=2) - 1.5).mean(1) \
-                                    ) * syn_mask)/max(syn_len, 1)
-            output_dict['syn_emb'] = (emb_syn1, emb_syn2)
+    def sample_negatives(self, num):
+        return self.sampler.draw(num)
 
-        if 'syn' in self.lex_rels and antonyms is not None:
-            batch_size = antonyms.size(0)
-            ant_mask = mask(antonyms) 
-            ant_len = torch.sum(ant_mask)
+    def reg_loss(self):
+        return orthogonality_loss([getattr(self, name) for name in ('syn_proj', 'hypn_proj', 'mern_proj')
+                                   if hasattr(self, name)])
 
-            emb_ant1 =self.syn_proj(self.embedding(antonyms[:, 0]))
-            emb_ant2 = self.syn_proj(self.embedding(antonyms[:, 1]))
+    def forward(self, synonyms=None, antonyms=None, hypernyms=None, meronyms=None):
+        # The relation pairs come without padding (see data.BatchIterator), so
+        # every row counts towards the losses.
+        #
+        # All relations are computed in one pass: the left, right and negative
+        # words of every relation are looked up with a single embedding call,
+        # grouped so that every projection is one matmul over its rows.
+        relations = [(rel, pairs) for rel, pairs in zip(['syn', 'ant', 'hyp', 'mer'], [synonyms, antonyms, hypernyms, meronyms])
+                     if pairs is not None and rel in self.proj_of]
+        if not relations:
+            return {}
+
+        sizes = [pairs.size(0) for _, pairs in relations]
+        if self.shared_negs > 0:
+            # one pool of negatives for every pair of every relation
+            nwords = [self.sample_negatives(self.shared_negs)]
+        else:
+            nwords = self.sample_negatives(sum(sizes) * self.n_negs).split([n * self.n_negs for n in sizes])
+
+        # word ids per projection: [left, right(, negatives)] of each of its relations
+        projs = []
+        proj_ids = []
+        segments = {}
+        for i, (rel, pairs) in enumerate(relations):
+            if self.proj_of[rel] not in projs:
+                projs.append(self.proj_of[rel])
+                proj_ids.append([])
+            proj = projs.index(self.proj_of[rel])
+            start = sum(ids.size(0) for ids in proj_ids[proj])
+            proj_ids[proj].extend([pairs[:, 0], pairs[:, 1]] if self.shared_negs > 0 else [pairs[:, 0], pairs[:, 1], nwords[i]])
+            segments[rel] = (proj, start, pairs.size(0))
+
+        lens = [sum(ids.size(0) for ids in group) for group in proj_ids]
+        if self.shared_negs > 0:
+            lens.append(self.shared_negs)
+            proj_ids.append(nwords)
+        embedded = self.embedding(torch.cat([ids for group in proj_ids for ids in group])).split(lens)
+        projected = [getattr(self, name)(emb) for name, emb in zip(projs, embedded)]
+        if self.shared_negs > 0:
+            # the pool is embedded once and projected once per projection
+            shared = [getattr(self, name)(embedded[-1]) for name in projs]
+
+        def split(rel):
+            proj, start, n = segments[rel]
+            out = projected[proj]
+            if self.shared_negs > 0:
+                negs = shared[proj].unsqueeze(0)
+            else:
+                negs = out[start + 2 * n:start + n * (2 + self.n_negs)].view(n, self.n_negs, self.wn_dim)
+            return out[start:start + n], out[start + n:start + 2 * n], negs, n
 
-            nwords= torch.multinomial(self.weights, batch_size * self.n_negs, replacement=True).view(batch_size, -1).cuda()
-            emb_ant_neg = self.syn_proj(self.embedding(nwords.view(batch_size, self.n_negs)).view(-1, self.emb_dim)).view(batch_size, self.n_negs, -1)
+        output_dict = {}
+        if 'syn' in segments:
+            emb_syn1, emb_syn2, emb_syn_neg, n = split('syn')
+            output_dict['loss_syn'] = torch.sum(self.dist_fn(emb_syn1, emb_syn2) \
+                                        + self.neg_wn_ratio * F.relu(self.n_margin - self.dist_fn(emb_syn1.unsqueeze(1), emb_syn_neg, dim=2)).mean(1) \
+                                        )/max(n, 1)
+            output_dict['syn_emb'] = (emb_syn1, emb_syn2)
 
+        if 'ant' in segments:
+            emb_ant1, emb_ant2, emb_ant_neg, n = split('ant')
             output_dict['loss_ant'] = torch.sum(F.relu(self.antonym_margin - self.dist_fn(emb_ant1, emb_ant2)) \
-                                        + self.neg_wn_ratio * F.relu(self.dist_fn(emb_ant1.view(batch_size, 1, -1), emb_ant_neg, dim=2) - 1.5).mean(1) \
-                                         * ant_mask )/max(ant_len, 1)
+                                        + self.neg_wn_ratio * F.relu(self.dist_fn(emb_ant1.unsqueeze(1), emb_ant_neg, dim=2) - 1.5).mean(1) \
+                                        )/max(n, 1)
             output_dict['ant_emb'] = (emb_ant1, emb_ant2)
 
-        if 'hyp' in self.lex_rels and hypernyms is not None:
-            batch_size = hypernyms.size(0)
-            hyp_mask = mask(hypernyms) 
-            hyp_len = torch.sum(hyp_mask)
-
-            emb_hypn1 = self.hypn_proj(self.embedding(hypernyms[:, 0]))
-            emb_hypn2 = self.hypn_proj(self.embedding(hypernyms[:, 1]))
-            emb_hypn1_rel = self.hypn_rel(emb_hypn1)
-
-            nwords = torch.multinomial(self.weights, batch_size * self.n_negs, replacement=True).view(batch_size, -1).cuda()
-            emb_hyp_neg = self.hypn_rel(self.hypn_proj(self.embedding(nwords.view(batch_size, self.n_negs)).view(-1, self.emb_dim)).view(batch_size, self.n_negs, -1))
-
-            output_dict['loss_hyp'] = torch.sum((self.dist_fn(emb_hypn1_rel, emb_hypn2) \
-                                        # + F.relu(1 - self.dist_fn(emb_hypn2, emb_hypn1)) \
-                                        + F.relu(1 - self.dist_fn(self.hypn_rel(emb_hypn2), emb_hypn1)) \
-                                        # + F.relu(1 - self.dist_fn(self.hypn_rel(emb_hypn2), self.hypn_rel(emb_hypn1))) \
-                                        + self.neg_wn_ratio * F.relu(1 - self.dist_fn(emb_hypn2.view(batch_size, 1, -1), emb_hyp_neg, dim=2)).mean(1) \
-                                        ) * hyp_mask)/max(hyp_len, 1)
+        if 'hyp' in segments:
+            emb_hypn1, emb_hypn2, emb_hyp_neg, n = split('hyp')
+            emb_hypn1_rel, emb_hypn2_rel = self.hypn_rel(torch.cat([emb_hypn1, emb_hypn2])).split([n, n])
+            emb_hyp_neg = self.hypn_rel(emb_hyp_neg)
 
+            output_dict['loss_hyp'] = torch.sum(self.dist_fn(emb_hypn1_rel, emb_hypn2) \
+                                        + F.relu(1 - self.dist_fn(emb_hypn2_rel, emb_hypn1)) \
+                                        + self.neg_wn_ratio * F.relu(1 - self.dist_fn(emb_hypn2.unsqueeze(1), emb_hyp_neg, dim=2)).mean(1) \
+                                        )/max(n, 1)
             output_dict['hyp_emb'] = (emb_hypn1, emb_hypn2)
 
-        if 'mer' in self.lex_rels and meronyms is not None:
-            batch_size = meronyms.size(0)
-            mer_mask = mask(meronyms) 
-            mer_len = torch.sum(mer_mask)
-
-            emb_mern1 = self.mern_proj(self.embedding(meronyms[:, 0]))
-            emb_mern2 = self.mern_proj(self.embedding(meronyms[:, 1]))
-            emb_mern1_rel = self.mern_rel(emb_mern1)
-
-            nwords = torch.multinomial(self.weights, batch_size * self.n_negs, replacement=True).view(batch_size, -1).cuda()
-            emb_mer_neg = self.mern_rel(self.mern_proj(self.embedding(nwords.view(batch_size, self.n_negs)).view(-1, self.emb_dim)).view(batch_size, self.n_negs, -1))
-
-            output_dict['loss_mer'] = torch.sum((self.dist_fn(emb_mern1_rel, emb_mern2) \
-                                        + self.neg_wn_ratio * F.relu(self.n_margin - self.dist_fn(emb_mern2.view(batch_size, 1, -1), emb_mer_neg, dim=2)).mean(1) \
-                                        # + F.relu(1 - self.dist_fn(emb_mern2, emb_mern1)) \
-                                        + F.relu(1 - self.dist_fn(self.mern_rel(emb_mern2), emb_mern1)) \
-                                        # + F.relu(1 - self.dist_fn(self.mern_rel(emb_mern2), self.mern_rel(emb_mern1))) \
-                                        ) * mer_mask)/max(mer_len, 1)
-                                    
+        if 'mer' in segments:
+            emb_mern1, emb_mern2, emb_mer_neg, n = split('mer')
+            emb_mern1_rel, emb_mern2_rel = self.mern_rel(torch.cat([emb_mern1, emb_mern2])).split([n, n])
+            emb_mer_neg = self.mern_rel(emb_mer_neg)
+
+            output_dict['loss_mer'] = torch.sum(self.dist_fn(emb_mern1_rel, emb_mern2) \
+                                        + self.neg_wn_ratio * F.relu(self.n_margin - self.dist_fn(emb_mern2.unsqueeze(1), emb_mer_neg, dim=2)).mean(1) \
+                                        + F.relu(1 - self.dist_fn(emb_mern2_rel, emb_mern1)) \
+                                        )/max(n, 1)
             output_dict['mer_emb'] = (emb_mern1, emb_mern2)
 
         return output_dict
@@ -617,6 +647,9 @@ class WNLM(nn.Module):
     def init_hidden(self, bsz):
         self.lm.init_hidden(bsz)
 
+    def reg_loss(self):
+        return self.wn.reg_loss()
+
     def forward(self, input, hidden, targets=None, synonyms=None, antonyms=None, hypernyms=None, meronyms=None):
         lm_out_dict = self.lm(input, hidden, targets)
         wn_out_dict = self.wn(synonyms, antonyms, hypernyms, meronyms)
@@ -636,6 +669,9 @@ class GloveModel(nn.Module):
         self.wn.init_weights()
         self.gl.init_weights()
 
+    def reg_loss(self):
+        return self.wn.reg_loss()
+
 
     def forward(self, input, synonyms=None, antonyms=None, hypernyms=None, meronyms=None):
         gl_out_dict = self.gl(input)
@@ -1,3 +1,4 @@
 from nce.index_linear import IndexLinear
 from nce.index_gru import IndexGRU
 from nce.nce_loss import NCELoss
+from nce.samplers import LogUniformSampler, build_sampler
@@ -1,5 +1,50 @@
 import torch
 
+
+def build_alias_table(probs):
+    '''Builds the alias table of `probs` with vectorized passes
+
+    Outcomes with probability below 1/K ("small") are paired with outcomes
+    above it ("large") in bulk: every large outcome owns an interval of the
+    cumulative excess mass, and each small outcome is aliased to the large one
+    whose interval contains the start of its cumulative deficit. Large outcomes
+    that gave away more than their excess become small in the next pass. This
+    is the same pairing as the sequential algorithm, done a round at a time.
+
+    Returns:
+        - prob: :math:`(K)` probability of keeping the drawn outcome
+        - alias: :math:`(K)` outcome to use instead
+    '''
+    probs = probs.detach().cpu().double()
+    K = probs.size(0)
+    prob = probs / probs.sum() * K
+    alias = torch.arange(K)
+
+    smaller = (prob < 1).nonzero().view(-1)
+    larger = (prob >= 1).nonzero().view(-1)
+    while smaller.numel() > 0 and larger.numel() > 0:
+        deficit = 1 - prob[smaller]
+        excess = prob[larger] - 1
+        deficit_start = torch.cumsum(deficit, 0) - deficit
+        owner = torch.searchsorted(torch.cumsum(excess, 0), deficit_start, right=True)
+
+        # numerical leftovers past the total excess keep themselves
+        covered = owner < larger.numel()
+        prob[smaller[~covered]] = 1
+        smaller, owner, deficit = smaller[covered], owner[covered], deficit[covered]
+
+        alias[smaller] = larger[owner]
+        given = torch.zeros_like(excess).index_add_(0, owner, deficit)
+        prob[larger] -= given
+
+        below = prob[larger] < 1
+        smaller = larger[below]
+        larger = larger[~below]
+
+    prob[smaller] = 1
+    prob[larger] = 1
+    return prob.float(), alias
+
 class AliasMultinomial(torch.nn.Module):
     '''Alias sampling method to speedup multinomial sampling
 
@@ -9,52 +54,21 @@ class AliasMultinomial(torch.nn.Module):
 
     Attributes:
         - probs: the probability density of desired multinomial distribution
+        - pool_size: if > 0, samples are drawn this many at a time and handed
+          out in slices by `draw`
 
     Refs:
         - https://hips.seas.harvard.edu/blog/2013/03/03/the-alias-method-efficient-sampling-with-many-discrete-outcomes/
     '''
-    def __init__(self, probs):
+    def __init__(self, probs, pool_size=0):
         super(AliasMultinomial, self).__init__()
+        self.pool_size = pool_size
+        self.pool = None
+        self.pool_pos = 0
 
-        probs = probs / probs.sum()
-        cpu_probs = probs.cpu()
-        K = len(probs)
-
-        # such a name helps to avoid the namespace check for nn.Module
-        self_prob = [0] * K
-        self_alias = [0] * K
-
-        # Sort the data into the outcomes with probabilities
-        # that are larger and smaller than 1/K.
-        smaller = []
-        larger = []
-        for idx, prob in enumerate(cpu_probs):
-            self_prob[idx] = K*prob
-            if self_prob[idx] < 1.0:
-                smaller.append(idx)
-            else:
-                larger.append(idx)
-
-        # Loop though and create little binary mixtures that
-        # appropriately allocate the larger outcomes over the
-        # overall uniform mixture.
-        while len(smaller) > 0 and len(larger) > 0:
-            small = smaller.pop()
-            large = larger.pop()
-
-            self_alias[small] = large
-            self_prob[large] = (self_prob[large] - 1.0) + self_prob[small]
-
-            if self_prob[large] < 1.0:
-                smaller.append(large)
-            else:
-                larger.append(large)
-
-        for last_one in smaller+larger:
-            self_prob[last_one] = 1
-
-        self.register_buffer('prob', torch.Tensor(self_prob))
-        self.register_buffer('alias', torch.LongTensor(self_alias))
+        prob, alias = build_alias_table(probs)
+        self.register_buffer('prob', prob)
+        self.register_buffer('alias', alias)
 
     def draw(self, *size):
         """Draw N samples from multinomial
@@ -62,6 +76,12 @@ class AliasMultinomial(torch.nn.Module):
         Args:
             - size: the output size of samples
         """
+        if self.pool_size > 0:
+            return self.draw_pooled(*size)
+        return self.sample(*size)
+
+    def sample(self, *size):
+        """Draws fresh samples, bypassing the pool"""
         max_value = self.alias.size(0)
 
         kk = self.alias.new(*size).random_(0, max_value).long().view(-1)
@@ -74,3 +94,16 @@ class AliasMultinomial(torch.nn.Module):
 
         return (oq + oj).view(size)
 
+    def draw_pooled(self, *size):
+        """Same as `draw`, slicing the samples from a pre-drawn pool"""
+        num = 1
+        for dim in size:
+            num *= dim
+
+        if self.pool is None or self.pool.device != self.alias.device or self.pool_pos + num > self.pool.size(0):
+            self.pool = self.sample(max(self.pool_size, num))
+            self.pool_pos = 0
+
+        samples = self.pool[self.pool_pos:self.pool_pos + num]
+        self.pool_pos += num
+        return samples.view(size)
@@ -2,6 +2,8 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .nce_loss import NCELoss
 
@@ -17,6 +19,9 @@ class IndexGRU(NCELoss):
         - nhid: GRU size
         - dropout: dropout rate for Embedding, GRU and Linear module
         the GRU is not dropout due to only one layer.
+        - share_noise_gates: when every position shares the same noises,
+        compute the input side of their gates once for all positions even in
+        training, with one dropout mask per noise instead of per position
 
     Parameters:
         - target_idx:(B, N) padded target index
@@ -24,8 +29,9 @@ class IndexGRU(NCELoss):
     """
 
     def __init__(self, ntoken, ninp, nhid, dropout,
-                 *args, **kwargs):
+                 *args, share_noise_gates=False, **kwargs):
         super(IndexGRU, self).__init__(*args, **kwargs)
+        self.share_noise_gates = share_noise_gates
 
         self.ntoken = ntoken
         self.nhid = nhid
@@ -99,6 +105,11 @@ class IndexGRU(NCELoss):
     def get_noise_score(self, noise_idx, rnn_output):
         """Get the score of noise given supervised context
 
+        The noises of a position are scored with one step of the GRU cell from
+        its hidden state. The hidden side of the gates is computed once per
+        position and broadcast against the input side of every noise, and the
+        noises are scored `score_memory` bytes of cell states at a time.
+
         Args:
             - noise_idx: (B, N, N_r) the noise word index
             - rnn_output: output of rnn model
@@ -107,18 +118,42 @@ class IndexGRU(NCELoss):
             - noise_score: (B, N, N_r) score for noise word index
         """
 
-        noise_emb = self.encoder(noise_idx.view(-1))
-        noise_ratio = noise_idx.size(2)
-
         # rnn_output of </s> is useless for sentence scoring
-        batched_rnn_output = rnn_output[:,:-1].unsqueeze(2).expand(
-            -1, -1, noise_ratio, -1
-        ).contiguous().view(1, -1, self.nhid)
+        hidden = rnn_output[:, :-1].unsqueeze(2)  # (B, N, 1, H)
+        hidden_gates = F.linear(hidden, self.rnn.weight_hh_l0, self.rnn.bias_hh_l0)
 
-        noise_output, _last_hidden = self.rnn(
-            noise_emb.view(-1, 1, self.nhid),
-            batched_rnn_output,
-        )
+        # noises shared by every position are only an expanded (N_r) tensor
+        shared = noise_idx.stride(0) == 0 and noise_idx.stride(1) == 0
+        if shared and (self.share_noise_gates or not self.training or self.drop.p == 0):
+            noise_idx = noise_idx[:1, :1]
 
-        noise_score = self.scorer(noise_output).view_as(noise_idx)
-        return noise_score
+        noise_ratio = noise_idx.size(2)
+        cols = noise_ratio
+        if self.score_memory > 0:
+            # the gates, cell state and dropout mask of every noise
+            per_col = hidden.size(0) * hidden.size(1) * self.nhid * 8 * rnn_output.element_size()
+            cols = max(1, self.score_memory // per_col)
+
+        if cols >= noise_ratio:
+            return self._score_noise_cols(noise_idx, hidden, hidden_gates)
+
+        scores = []
+        for c in range(0, noise_ratio, cols):
+            idx = noise_idx[:, :, c:c + cols]
+            if torch.is_grad_enabled():
+                scores.append(checkpoint(self._score_noise_cols, idx, hidden, hidden_gates, use_reentrant=False))
+            else:
+                scores.append(self._score_noise_cols(idx, hidden, hidden_gates))
+        return torch.cat(scores, dim=2)
+
+    def _score_noise_cols(self, noise_idx, hidden, hidden_gates):
+        """One GRU cell step from `hidden` over the noises, same as `self.rnn`"""
+        input_gates = F.linear(self.encoder(noise_idx), self.rnn.weight_ih_l0, self.rnn.bias_ih_l0)
+        i_r, i_z, i_n = input_gates.chunk(3, dim=-1)
+        h_r, h_z, h_n = hidden_gates.chunk(3, dim=-1)
+
+        reset = torch.sigmoid(i_r + h_r)
+        update = torch.sigmoid(i_z + h_z)
+        new = torch.tanh(i_n + reset * h_n)
+        noise_output = new + update * (hidden - new)  # (B, N, N_r, H)
+        return self.scorer(noise_output).squeeze(-1)
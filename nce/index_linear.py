@@ -23,10 +23,15 @@ class IndexLinear(NCELoss):
     Return:
         - target_score :math:`(N, 1)`
         - noise_score :math:`(N, N_r)` the un-normalized score
+
+    Attributes:
+        ce_memory: if > 0, the full softmax of `ce_loss` is computed in blocks
+        of at most this many bytes of scores instead of all at once
     """
 
-    def __init__(self, embedding_dim, num_classes, *args, **kwargs):
+    def __init__(self, embedding_dim, num_classes, *args, ce_memory=0, **kwargs):
         super(IndexLinear, self).__init__(*args, **kwargs)
+        self.ce_memory = ce_memory
         # use Embedding to store the output embedding
         # it's efficient when it comes sparse update of gradients
         self.emb = nn.Embedding(num_classes, embedding_dim)
@@ -39,8 +44,7 @@ class IndexLinear(NCELoss):
         self.emb.weight.data.uniform_(-stdv, stdv)
         if self.bias is not None:
             # initialize the bias with unigram instead of uniform
-            self.bias.weight.data = torch.log(self.noise + 1e-10) + self.norm_term
-            self.bias.weight.data.unsqueeze_(1)
+            self.bias.weight.data = (torch.log(self.noise + 1e-10) + self.norm_term).unsqueeze(1)
 
     def get_score(self, target_idx, noise_idx, input):
         """
@@ -139,9 +143,51 @@ class IndexLinear(NCELoss):
 
 
     def ce_loss(self, target_idx, input):
+        if self.ce_memory > 0:
+            return self._chunked_ce_loss(target_idx, input)
+
         score = F.linear(input, self.emb.weight, self.bias.weight.squeeze(1))  # (N, V)
         loss = self.ce(
             score.view(-1, score.size(-1)),
             target_idx.view(-1)
         ).view_as(target_idx)
         return loss
+
+    def _chunk_sizes(self, num_rows, element_size):
+        """Rows and classes per block so that a block of scores fits in `ce_memory`
+
+        Blocks span all rows and are only split along the rows when even a
+        single class per block would not fit.
+        """
+        num_classes = self.emb.num_embeddings
+        # the scores and the exp() temporary of logsumexp
+        budget = max(1, self.ce_memory // (2 * element_size))
+        cols = min(num_classes, max(1, budget // num_rows))
+        rows = min(num_rows, max(1, budget // cols))
+        return rows, cols
+
+    def _chunked_ce_loss(self, target_idx, input):
+        """Same as the full `ce_loss`, scoring the vocabulary block by block
+
+        The normalizer is accumulated as a running log-sum-exp over blocks of
+        classes, so the (N, V) score matrix is never materialized.
+        """
+        weight = self.emb.weight
+        bias = self.bias.weight.squeeze(1)
+        input = input.contiguous().view(-1, input.size(-1))  # (N, E)
+        target = target_idx.contiguous().view(-1)
+
+        rows, cols = self._chunk_sizes(input.size(0), input.element_size())
+        losses = []
+        for r in range(0, input.size(0), rows):
+            x = input[r:r + rows]
+            log_norm = None
+            for c in range(0, weight.size(0), cols):
+                score = torch.addmm(bias[c:c + cols], x, weight[c:c + cols].t())
+                block = torch.logsumexp(score, dim=1)
+                log_norm = block if log_norm is None else torch.logaddexp(log_norm, block)
+
+            t = target[r:r + rows]
+            target_score = torch.sum(x * weight[t], dim=1) + bias[t]
+            losses.append(log_norm - target_score)
+        return torch.cat(losses).view_as(target_idx)
@@ -4,7 +4,7 @@ import math
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 from .alias_multinomial import AliasMultinomial
 
 
@@ -35,6 +35,15 @@ class NCELoss(nn.Module):
         'elementwise_mean' and 'sum' are supported.
         loss_type: loss type of this module, currently 'full', 'sampled', 'nce'
         are supported
+        noise_buffer: if > 0, noise samples and their noise probabilities are
+        drawn this many at a time and every step slices the next ones
+        sampler: the module drawing from `noise`, see `nce.samplers`, defaults
+        to an alias table of `noise`
+        score_memory: if > 0, the noises of at most this many bytes of scores
+        are scored at once, and the blocks are recomputed in backward instead
+        of being kept
+        mix_weight: weight of the NCE loss in the 'mix' loss, the sampled
+        softmax loss gets the rest
 
     Shape:
         - noise: :math:`(V)` where `V = vocabulary size`
@@ -57,11 +66,15 @@ class NCELoss(nn.Module):
                  reduction='elementwise_mean',
                  per_word=False,
                  loss_type='nce',
+                 noise_buffer=0,
+                 sampler=None,
+                 score_memory=0,
+                 mix_weight=0.5,
                  ):
         super(NCELoss, self).__init__()
 
         self.register_buffer('noise', noise)
-        self.alias = AliasMultinomial(noise)
+        self.sampler = sampler if sampler is not None else AliasMultinomial(noise)
         self.noise_ratio = noise_ratio
         if norm_term == 'auto':
             self.norm_term = math.log(noise.numel())
@@ -72,6 +85,12 @@ class NCELoss(nn.Module):
         self.bce = nn.BCELoss(reduction='none')
         self.ce = nn.CrossEntropyLoss(reduction='none')
         self.loss_type = loss_type
+        self.noise_buffer = noise_buffer
+        self.buffer_ids = None
+        self.buffer_probs = None
+        self.buffer_pos = 0
+        self.score_memory = score_memory
+        self.mix_weight = mix_weight
 
     def forward(self, target, *args, **kwargs):
         """compute the loss with output and the desired target
@@ -85,46 +104,22 @@ class NCELoss(nn.Module):
         max_len = target.size(1)
         if self.loss_type != 'full':
 
-            noise_samples = self.get_noise(batch, max_len)
-
             # B,N,Nr
-            prob_noise = Variable(
-                self.noise[noise_samples.data.view(-1)].view_as(noise_samples)
-            )
-            prob_target_in_noise = Variable(
-                self.noise[target.data.view(-1)].view_as(target)
-            )
-
-            # (B,N), (B,N,Nr)
-            prob_model, prob_noise_in_model = self._get_prob(target, noise_samples, *args, **kwargs)
-
-            if self.loss_type == 'nce':
-                if self.training:
-                    loss = self.nce_loss(
-                        prob_model, prob_noise_in_model,
-                        prob_noise, prob_target_in_noise,
-                    )
-                else:
-                    # directly output the approximated posterior
-                    loss = - prob_model.log()
-            elif self.loss_type == 'sampled':
-                loss = self.sampled_softmax_loss(
-                    prob_model, prob_noise_in_model,
-                    prob_noise, prob_target_in_noise,
-                )
-            elif self.loss_type == 'mix' and self.training:
-                loss = 0.5 * self.nce_loss(
-                    prob_model, prob_noise_in_model,
-                    prob_noise, prob_target_in_noise,
-                )
-                loss += 0.5 * self.sampled_softmax_loss(
-                    prob_model, prob_noise_in_model,
-                    prob_noise, prob_target_in_noise,
-                )
+            noise_samples, prob_noise = self.get_noise(batch, max_len)
 
+            rows = self._tile_rows(max_len, prob_noise.element_size())
+            if rows >= batch:
+                loss = self._sampled_loss(target, noise_samples, prob_noise, *args, **kwargs)
             else:
-                current_stage = 'training' if self.training else 'inference'
-                raise NotImplementedError('loss type {} not implemented at {}'.format(self.loss_type, current_stage))
+                losses = []
+                for r in range(0, batch, rows):
+                    inputs = [t[r:r + rows] for t in (target, noise_samples, prob_noise) + args]
+                    if torch.is_grad_enabled():
+                        # the (rows, N, Nr) intermediates are recomputed in backward
+                        losses.append(checkpoint(self._sampled_loss, *inputs, use_reentrant=False, **kwargs))
+                    else:
+                        losses.append(self._sampled_loss(*inputs, **kwargs))
+                loss = torch.cat(losses)
 
         else:
             # Fallback into conventional cross entropy
@@ -137,20 +132,89 @@ class NCELoss(nn.Module):
         else:
             return loss
 
+    def _tile_rows(self, max_len, element_size):
+        """Rows of the batch scored at once so that a (rows, N, N_r) block of noise
+        scores fits in `score_memory`"""
+        if self.score_memory <= 0:
+            return float('inf')
+        return max(1, self.score_memory // (max_len * (self.noise_ratio + 1) * element_size))
+
+    def _sampled_loss(self, target, noise_samples, prob_noise, *args, **kwargs):
+        """The `loss_type` loss of every target given its noises"""
+        prob_target_in_noise = self.noise[target.reshape(-1)].view_as(target)
+
+        # (B,N), (B,N,Nr)
+        prob_model, prob_noise_in_model = self._get_prob(target, noise_samples, *args, **kwargs)
+
+        if self.loss_type == 'nce':
+            if self.training:
+                loss = self.nce_loss(
+                    prob_model, prob_noise_in_model,
+                    prob_noise, prob_target_in_noise,
+                )
+            else:
+                # directly output the approximated posterior
+                loss = - prob_model.log()
+        elif self.loss_type == 'sampled':
+            loss = self.sampled_softmax_loss(
+                prob_model, prob_noise_in_model,
+                prob_noise, prob_target_in_noise,
+            )
+        elif self.loss_type == 'mix' and self.training:
+            loss = self.mix_weight * self.nce_loss(
+                prob_model, prob_noise_in_model,
+                prob_noise, prob_target_in_noise,
+            )
+            loss += (1 - self.mix_weight) * self.sampled_softmax_loss(
+                prob_model, prob_noise_in_model,
+                prob_noise, prob_target_in_noise,
+            )
+
+        else:
+            current_stage = 'training' if self.training else 'inference'
+            raise NotImplementedError('loss type {} not implemented at {}'.format(self.loss_type, current_stage))
+        return loss
+
     def get_noise(self, batch_size, max_len):
-        """Generate noise samples from noise distribution"""
+        """Generate noise samples from noise distribution
+
+        Returns:
+            - noise_samples: :math:`(B, N, N_r)` the noise indices
+            - prob_noise: :math:`(B, N, N_r)` their probabilities in the noise
+        """
 
         if self.per_word:
-            noise_samples = self.alias.draw(
-                batch_size,
-                max_len,
-                self.noise_ratio,
-            )
+            noise_samples, prob_noise = self.draw_noise(batch_size * max_len * self.noise_ratio)
+            noise_samples = noise_samples.view(batch_size, max_len, self.noise_ratio)
+            prob_noise = prob_noise.view_as(noise_samples)
         else:
-            noise_samples = self.alias.draw(1, 1, self.noise_ratio).expand(batch_size, max_len, self.noise_ratio)
+            # the same noises for every target, only expanded
+            noise_samples, prob_noise = self.draw_noise(self.noise_ratio)
+            noise_samples = noise_samples.view(1, 1, -1).expand(batch_size, max_len, -1)
+            prob_noise = prob_noise.view(1, 1, -1).expand(batch_size, max_len, -1)
+
+        return noise_samples, prob_noise
 
-        noise_samples = Variable(noise_samples).contiguous()
-        return noise_samples
+    def draw_noise(self, num):
+        """Draws `num` noise samples and their noise probabilities
+
+        With `noise_buffer` the samples are sliced from a buffer which is
+        refilled `noise_buffer` samples at a time once exhausted.
+        """
+        if self.noise_buffer <= 0:
+            samples = self.sampler.draw(num)
+            return samples, self.noise[samples]
+
+        if self.buffer_ids is None or self.buffer_ids.device != self.noise.device \
+                or self.buffer_pos + num > self.buffer_ids.size(0):
+            self.buffer_ids = self.sampler.draw(max(self.noise_buffer, num))
+            self.buffer_probs = self.noise[self.buffer_ids]
+            self.buffer_pos = 0
+
+        samples = self.buffer_ids[self.buffer_pos:self.buffer_pos + num]
+        probs = self.buffer_probs[self.buffer_pos:self.buffer_pos + num]
+        self.buffer_pos += num
+        return samples, probs
 
     def _get_prob(self, target_idx, noise_idx, *args, **kwargs):
         """Get the NCE estimated probability for target and noise
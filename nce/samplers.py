@@ -0,0 +1,72 @@
+"""Noise samplers for the NCE modules
+
+A sampler is a module with a `draw(*size)` method returning class indices.
+`build_sampler` returns one together with the noise distribution it draws
+from, which is what NCELoss takes as `noise`.
+"""
+import math
+
+import torch
+import torch.nn as nn
+
+from .alias_multinomial import AliasMultinomial
+
+
+class LogUniformSampler(nn.Module):
+    """Draws from the log-uniform (Zipfian) distribution over class indices
+
+        P(k) = (log(r + 2) - log(r + 1)) / log(V - S + 1),  r = k - S
+
+    for the indices `k >= S` and 0 for the `S` special tokens in front of
+    them. It assumes the classes are sorted by decreasing frequency, as in a
+    torchtext vocab, and needs no table: a draw is `exp` of a uniform sample.
+
+    Attributes:
+        - num_classes: the number of classes `V`
+        - num_special: the number of special tokens `S` never drawn, e.g.
+          `<unk>` and `<pad>` at the start of a torchtext vocab
+    """
+    def __init__(self, num_classes, num_special=0):
+        super(LogUniformSampler, self).__init__()
+        self.num_special = num_special
+        self.log_range = math.log(num_classes - num_special + 1)
+        r = torch.arange(num_classes - num_special, dtype=torch.double)
+        probs = torch.zeros(num_classes, dtype=torch.double)
+        probs[num_special:] = (torch.log(r + 2) - torch.log(r + 1)) / self.log_range
+        self.register_buffer('probs', probs.float())
+
+    def draw(self, *size):
+        """Draw samples of the given size"""
+        u = torch.rand(*size, device=self.probs.device, dtype=torch.double)
+        samples = torch.exp(u * self.log_range).long() - 1 + self.num_special
+        return samples.clamp_(self.num_special, self.probs.size(0) - 1)
+
+
+def unigram_noise(freq, power=1.):
+    """Noise distribution of the unigram frequencies `freq` raised to `power`"""
+    noise = freq.double().pow(power)
+    return (noise / noise.sum()).float()
+
+
+def build_sampler(name, freq, power=1., num_special=2):
+    """Builds the sampler `name` for a vocab of word counts `freq`
+
+    Args:
+        - name: 'unigram' draws from the unigram distribution raised to
+          `power` with an alias table, 'log_uniform' from the log-uniform
+          distribution over the (frequency sorted) indices
+        - freq: :math:`(V)` occurrences of every index
+        - num_special: the number of special tokens at the start of the
+          vocab that 'log_uniform' never draws, `<unk>` and `<pad>` by default
+
+    Returns:
+        - noise: :math:`(V)` the noise distribution
+        - sampler: the module drawing from it
+    """
+    if name == 'unigram':
+        noise = unigram_noise(freq, power)
+        return noise, AliasMultinomial(noise)
+    elif name == 'log_uniform':
+        sampler = LogUniformSampler(freq.size(0), num_special)
+        return sampler.probs.clone(), sampler
+    raise ValueError('Unknown noise sampler {}, options are [unigram, log_uniform]'.format(name))
@@ -0,0 +1,160 @@
+"""Writers for the annotated corpora produced by preprocessing/main.py."""
+import array
+import codecs
+import json
+import os
+
+import numpy as np
+
+try:
+    import orjson
+
+    def encode_record(record):
+        return orjson.dumps(record)
+
+    decode_record = orjson.loads
+
+except ImportError:
+    # Same compact, non-escaped output as orjson so the files do not depend
+    # on which encoder is installed.
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def encode_record(record):
+        return _encoder.encode(record).encode('utf-8')
+
+    decode_record = json.loads
+
+# Fields of the binary corpus, see `write_binary_corpus`. These are the
+# fields main.py trains on; the relations are stored as (a, b) pairs.
+SEQUENCE_FIELDS = ['text', 'target']
+RELATION_FIELDS = ['synonyms', 'antonyms', 'hypernyms', 'meronyms']
+
+
+class RecordWriter(object):
+    """Writes records as JSON lines.
+
+    Records are encoded `batch_size` at a time and written through a
+    `buffer_size` bytes file buffer instead of one write (and flush) per line.
+    """
+
+    def __init__(self, path, batch_size=1024, buffer_size=1 << 20, append=False):
+        self.file = open(path, 'ab' if append else 'wb', buffering=buffer_size)
+        self.batch_size = batch_size
+        self.batch = []
+
+    def write(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.file.write(b'\n'.join([encode_record(r) for r in self.batch]) + b'\n')
+            self.batch = []
+
+    def sync(self):
+        """Writes everything out to disk, e.g. before recording a checkpoint."""
+        self.flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _ArrayFile(object):
+    """Appends to a raw array file in chunks."""
+
+    def __init__(self, path, typecode, chunk_size=1 << 20):
+        self.file = open(path, 'wb')
+        self.buf = array.array(typecode)
+        self.chunk_size = chunk_size
+        self.length = 0
+
+    def extend(self, values):
+        self.buf.extend(values)
+        self.length += len(values)
+        if len(self.buf) >= self.chunk_size:
+            self.buf.tofile(self.file)
+            del self.buf[:]
+
+    def close(self):
+        self.buf.tofile(self.file)
+        self.file.close()
+
+
+def write_binary_corpus(in_paths, out_dir, relation_fields=RELATION_FIELDS):
+    """Converts JSON lines files into the binary corpus read by main.py --binary.
+
+    Every field is a flat array of int32 word ids, `<field>.bin`, with an int64
+    array `<field>_offsets.bin` of `num_examples + 1` entries delimiting the ids
+    of each example. Relation fields hold one (a, b) row per pair. Ids refer to
+    `words.txt`, `counts.npy` counts the words over text and target, which is
+    what the vocabulary is built from. Text only corpora are written with no
+    `relation_fields`.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    words = []
+    word_ids = {}
+    counts = []
+
+    def to_ids(tokens, count=False):
+        ids = []
+        for w in tokens:
+            if w not in word_ids:
+                words.append(w)
+                counts.append(0)
+                word_ids[w] = len(words) - 1
+            ids.append(word_ids[w])
+            if count:
+                counts[word_ids[w]] += 1
+        return ids
+
+    data = {}
+    offsets = {}
+    for field in SEQUENCE_FIELDS + relation_fields:
+        data[field] = _ArrayFile(os.path.join(out_dir, field + '.bin'), 'i')
+        offsets[field] = _ArrayFile(os.path.join(out_dir, field + '_offsets.bin'), 'q')
+        offsets[field].extend([0])
+
+    num_examples = 0
+    for in_path in in_paths:
+        with open(in_path, 'rb') as f:
+            for line in f:
+                record = decode_record(line)
+                for field in SEQUENCE_FIELDS:
+                    data[field].extend(to_ids(record[field].split(), count=True))
+                    offsets[field].extend([data[field].length])
+
+                for field in relation_fields:
+                    a = to_ids(record[field + '_a'].split())
+                    b = to_ids(record[field + '_b'].split())
+                    data[field].extend([w for pair in zip(a, b) for w in pair])
+                    offsets[field].extend([data[field].length // 2])
+                num_examples += 1
+
+    for field in SEQUENCE_FIELDS + relation_fields:
+        data[field].close()
+        offsets[field].close()
+
+    np.save(os.path.join(out_dir, 'counts.npy'), np.array(counts, dtype=np.int64))
+    with codecs.open(os.path.join(out_dir, 'words.txt'), 'w', encoding='utf-8') as f:
+        for w in words:
+            f.write(w + '\n')
+
+    # meta.json is written last, a corpus without it is incomplete.
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'num_examples': num_examples, 'num_words': len(words),
+                   'sequence_fields': SEQUENCE_FIELDS, 'relation_fields': relation_fields}, f)
@@ -1,5 +1,6 @@
 # coding: utf-8
 import argparse
+import array
 import json
 import time
 import math
@@ -7,15 +8,31 @@ import os
 import nltk
 from nltk.corpus import wordnet
 from nltk.corpus import stopwords
-from random import shuffle
 import codecs
 import random
 import string
 import glob
+import hashlib
+import multiprocessing
+import resource
+import sys
+import shutil
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import wn_index
+from corpus_writer import RELATION_FIELDS, RecordWriter, write_binary_corpus
 
 stopwords = nltk.corpus.stopwords.words('english')
-random.seed(1234)
+
+# Windows are annotated in blocks of this size, each with its own RNG seeded
+# from the block index. Shards always start on a block boundary so that a
+# sharded run draws exactly the same shuffles as a serial one.
+RNG_BLOCK = 1024
+# Number of token ids buffered while a file is converted to a TokenArray.
+TOKEN_CHUNK = 1 << 20
 
 parser = argparse.ArgumentParser(description='Preprocessing for finding synonym/antonym relations')
 parser.add_argument('--data', type=str, default='../data/glove',
@@ -36,8 +53,36 @@ parser.add_argument('--version', type=int, default=2,
                     help='Version of the code to run.')
 parser.add_argument('--from_file', action='store_true',
                     help='select relations from file.')
+parser.add_argument('--seed', type=int, default=1234,
+                    help='random seed')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of processes used to annotate the corpus.')
+parser.add_argument('--keep_shards', action='store_true',
+                    help='Keep one output file per shard instead of merging them.')
+parser.add_argument('--write_batch', type=int, default=1024,
+                    help='Number of records encoded per write.')
+parser.add_argument('--write_buffer', type=int, default=1 << 20,
+                    help='Size in bytes of the output file buffer.')
+parser.add_argument('--checkpoint_every', type=int, default=100000,
+                    help='Number of windows between checkpoints of the annotation progress, rounded up to '
+                         'a multiple of {} (the windows sharing a random state are checkpointed together).'.format(RNG_BLOCK))
+parser.add_argument('--text_only', action='store_true',
+                    help='Only write text and target, and the pair tables used by main.py --pairs_per_step.')
+parser.add_argument('--binary', action='store_true',
+                    help='Also write every split as a pre-numericalized binary corpus (see main.py --binary).')
+parser.add_argument('--index_dir', type=str, default=None,
+                    help='Location of the relation index (default: a directory in --data keyed on the vocab).')
+parser.add_argument('--build_index', action='store_true',
+                    help='Only build the relation index of the vocab and exit.')
+parser.add_argument('--no_index', action='store_true',
+                    help='Query WordNet for every word instead of using the relation index.')
 
 args = parser.parse_args()
+# checkpoints fall on RNG block boundaries
+checkpoint_windows = max(int(math.ceil(args.checkpoint_every / RNG_BLOCK)), 1) * RNG_BLOCK
+if checkpoint_windows != args.checkpoint_every:
+    print('Checkpointing every {} windows (--checkpoint_every {} rounded up to a multiple of {})'.format(
+        checkpoint_windows, args.checkpoint_every, RNG_BLOCK))
 word2idx = {}
 idx2word = []
 
@@ -83,7 +128,7 @@ def add_word(word):
 
 
 def create_vocab(in_path, add_eos=True):
-    for w in get_tokens_from_file(in_path, add_eos):
+    for w in iter_tokens(in_path, add_eos):
         add_word(w)
 
 def get_wordnet_pos(treebank_tag):
@@ -215,7 +260,110 @@ global_hyponyms = set([])
 global_meronyms = set([])
 global_holonyms = set([])
 
-def get_lexical_relations_seq(text):
+def compute_relations(w):
+    """Queries WordNet for the relations of `w`, None if it has no WordNet pos."""
+    # use simple nltk pos tagger for now
+    pos_tags = nltk.pos_tag(w)
+    # consider only adjectives for synonyms and antonyms
+    p = get_wordnet_pos(pos_tags[-1][1])
+    if p is None:
+        return None
+
+    word_syn, word_ant, \
+        word_hyp, word_hypo, \
+        word_mer, word_hol = get_lexical_relations(w, word2idx)
+
+    return {
+            'synonyms': word_syn,
+            'antonyms': word_ant,
+            'hypernyms': word_hyp,
+            'hyponyms': word_hypo,
+            'meronyms': word_mer,
+            'holonyms': word_hol
+            }
+
+# Relation index of the vocabulary, see `load_relation_index`. Words missing
+# from it (e.g. valid/test words outside the train vocab) fall back to WordNet.
+relation_index = None
+
+def lookup_relations(w):
+    """Returns the (memoized) relations of `w`, or None if it has no WordNet pos."""
+    if w not in global_syn2rel:
+        if relation_index is not None and w in relation_index:
+            global_syn2rel[w] = relation_index.relations(w)
+        else:
+            global_syn2rel[w] = compute_relations(w)
+
+    return global_syn2rel[w]
+
+def compute_relations_chunk(words):
+    return [compute_relations(w) for w in words]
+
+def build_relation_index(path, key):
+    """Computes the relations of every vocabulary word once and saves them at `path`."""
+    chunk_size = 1000
+    chunks = [preprocessing(idx2word[i:i + chunk_size]) for i in range(0, len(idx2word), chunk_size)]
+
+    table = {}
+    if args.workers > 1:
+        # a worker that dies raises BrokenProcessPool instead of blocking the build
+        with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            results = pool.map(compute_relations_chunk, chunks)
+            for i, (chunk, rels) in enumerate(zip(chunks, results)):
+                table.update(zip(chunk, rels))
+                print('Relation index: {}/{}'.format(min((i + 1) * chunk_size, len(idx2word)), len(idx2word)), end='\r')
+    else:
+        for i, chunk in enumerate(chunks):
+            table.update(zip(chunk, compute_relations_chunk(chunk)))
+            print('Relation index: {}/{}'.format(min((i + 1) * chunk_size, len(idx2word)), len(idx2word)), end='\r')
+    print()
+
+    wn_index.save_index(path, idx2word, [table.get(w) for w in idx2word], key)
+
+def relation_key():
+    """Fingerprint of the vocab and of the options the relations depend on."""
+    config = {'lower': args.lower, 'version': args.version, 'from_file': args.from_file}
+    if args.from_file:
+        # the relations come from the pair files, so their contents are part of the key
+        for filename in ['syn_v%d.txt', 'ant_v%d.txt', 'hyp_v%d.txt', 'mer_v%d.txt']:
+            filename = filename % args.version
+            if os.path.exists(filename):
+                with open(filename, 'rb') as f:
+                    config[filename] = hashlib.md5(f.read()).hexdigest()
+
+    return wn_index.fingerprint(idx2word, config)
+
+def load_relation_index():
+    key = relation_key()
+    path = args.index_dir or os.path.join(args.data, 'wn_index_v{}_{}'.format(args.version, key[:10]))
+
+    index = wn_index.load_index(path, key)
+    if index is None:
+        print('Building relation index: %s' % path)
+        build_relation_index(path, key)
+        index = wn_index.load_index(path, key)
+    else:
+        print('Loaded relation index: %s' % path)
+    return index
+
+def collect_global_relations(tokens):
+    for w in preprocessing(set(tokens)):
+        rels = lookup_relations(w)
+        if rels is None:
+            continue
+
+        global_synonyms.update(rels['synonyms'])
+        global_antonyms.update(rels['antonyms'])
+        global_hypernyms.update(rels['hypernyms'])
+        global_hyponyms.update(rels['hyponyms'])
+        global_meronyms.update(rels['meronyms'])
+        global_holonyms.update(rels['holonyms'])
+
+def get_lexical_relations_seq(text, rng=random):
+    if args.text_only:
+        # relations are sampled from the global pair tables during training
+        return {}
+
     synonyms = set([])
     antonyms = set([])
     hypernyms = set([])
@@ -225,67 +373,29 @@ def get_lexical_relations_seq(text):
     preprocessed_text = preprocessing(text)
 
     for w in preprocessed_text:
-        if w not in global_syn2rel:
-            # use simple nltk pos tagger for now
-            pos_tags = nltk.pos_tag(w)
-            # consider only adjectives for synonyms and antonyms
-            p = get_wordnet_pos(pos_tags[-1][1])
-            global_syn2rel[w] = { 'pos': p}
-
-            if p is None:
-                continue
-
-            word_syn, word_ant, \
-                word_hyp, word_hypo, \
-                word_mer, word_hol = get_lexical_relations(w, word2idx)
-
-            global_syn2rel[w].update({
-                    'synonyms': word_syn,
-                    'antonyms': word_ant,
-                    'hypernyms': word_hyp,
-                    'hyponyms': word_hypo,
-                    'meronyms': word_mer,
-                    'holonyms': word_hol
-                    })
+        rels = lookup_relations(w)
+        if rels is None:
+            continue
+
+        synonyms.update(rels['synonyms'])
+        antonyms.update(rels['antonyms'])
+        hypernyms.update(rels['hypernyms'])
+        hyponyms.update(rels['hyponyms'])
+        meronyms.update(rels['meronyms'])
+        holonyms.update(rels['holonyms'])
 
-        else:
-            if global_syn2rel[w]['pos'] is None:
-                continue
-
-            word_syn = global_syn2rel[w]['synonyms']
-            word_ant = global_syn2rel[w]['antonyms']
-            word_hyp = global_syn2rel[w]['hypernyms']
-            word_hypo = global_syn2rel[w]['hyponyms']
-            word_mer = global_syn2rel[w]['meronyms']
-            word_hol = global_syn2rel[w]['holonyms']
-
-        synonyms.update(word_syn)
-        antonyms.update(word_ant)
-        hypernyms.update(word_hyp)
-        hyponyms.update(word_hypo)
-        meronyms.update(word_mer)
-        holonyms.update(word_hol)
-
-
-        global_synonyms.update(word_syn)
-        global_antonyms.update(word_ant)
-        global_hypernyms.update(word_hyp)
-        global_hyponyms.update(word_hypo)
-        global_meronyms.update(word_mer)
-        global_holonyms.update(word_hol)
-   
     synonyms = sorted(list(synonyms))
     antonyms = sorted(list(antonyms))
     hypernyms = sorted(list(hypernyms))
     hyponyms = sorted(list(hyponyms))
     meronyms = sorted(list(meronyms))
     holonyms = sorted(list(holonyms))
-    shuffle(synonyms)
-    shuffle(antonyms)
-    shuffle(hypernyms)
-    shuffle(hyponyms)
-    shuffle(meronyms)
-    shuffle(holonyms)
+    rng.shuffle(synonyms)
+    rng.shuffle(antonyms)
+    rng.shuffle(hypernyms)
+    rng.shuffle(hyponyms)
+    rng.shuffle(meronyms)
+    rng.shuffle(holonyms)
 
     # synonym_str = ' '.join([','.join(syn) for syn in synonyms[:args.max_pair]])
     # antonym_str = ' '.join([','.join(ant) for ant in antonyms[:args.max_pair]])
@@ -329,122 +439,363 @@ def get_lexical_relations_seq(text):
            }
 
 
-def get_tokens_from_file(in_path, add_eos=True):
-    with codecs.open(in_path, 'r', encoding="utf8") as f:
-        tokens = []
-        for line in f:
-            words = line.split()
-            if add_eos:
-                words = words + ['<eos>']
-            tokens.extend(words)
-    return tokens
-
-def get_tokens_with_dict(in_path, add_eos=True):
+def iter_tokens(in_path, add_eos=True):
     with codecs.open(in_path, 'r', encoding="utf8") as f:
-        tokens = []
         for line in f:
             words = line.split()
             if add_eos:
                 words = words + ['<eos>']
-            tokens.extend(words)
-
-    return tokens, Counter(tokens)
-
-
-def create_rnn_corpus(in_path, out_path):
-    tokens = get_tokens_from_file(in_path, add_eos=True)
-
-    num_batches = int(math.ceil(len(tokens)/args.batch_size))
-    batched_input = []
-    for batch in range(0, len(tokens), num_batches):
-        batched_input.append(tokens[batch:batch + num_batches])
-
-    with codecs.open(out_path, 'w', encoding="utf-8") as out_file:
-        outputs = []
-        for i in range(0, num_batches, args.bptt):
-            seq_len = min(args.bptt, num_batches - i - 1)
+            for w in words:
+                yield w
+
+class TokenArray(object):
+    """Token stream of a file, kept on disk as a memory-mapped array of int32 ids.
+
+    Only the distinct words are held in memory. Indexing and slicing return
+    words, so it can be used in place of a list of tokens.
+    """
+
+    def __init__(self, in_path, ids_path, add_eos=True):
+        self.ids_path = ids_path
+        self.words = []
+        word_ids = {}
+
+        with open(ids_path, 'wb') as ids_file:
+            buf = array.array('i')
+            for w in iter_tokens(in_path, add_eos):
+                if w not in word_ids:
+                    self.words.append(w)
+                    word_ids[w] = len(self.words) - 1
+                buf.append(word_ids[w])
+
+                if len(buf) >= TOKEN_CHUNK:
+                    buf.tofile(ids_file)
+                    del buf[:]
+            buf.tofile(ids_file)
+
+        if os.path.getsize(ids_path) > 0:
+            self.ids = np.memmap(ids_path, dtype=np.int32, mode='r')
+        else:
+            self.ids = np.zeros(0, dtype=np.int32)
 
-            if seq_len < args.bptt:
-                continue
+    def __len__(self):
+        return len(self.ids)
 
-            for k in range(args.batch_size):
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.words[i] for i in self.ids[key].tolist()]
+        return self.words[self.ids[key]]
 
-                text = batched_input[k][i:i+seq_len]
-                if len(text) == 0:
-                    continue
+    def counts(self):
+        """Returns a Counter of the words, computed chunk by chunk."""
+        counts = np.zeros(len(self.words), dtype=np.int64)
+        for i in range(0, len(self.ids), TOKEN_CHUNK):
+            chunk = self.ids[i:i + TOKEN_CHUNK]
+            counts += np.bincount(chunk, minlength=len(self.words))
+        return Counter(dict(zip(self.words, counts.tolist())))
 
-                target = batched_input[k][i+1:i+1+seq_len]
+    def close(self):
+        self.ids = None
+        os.remove(self.ids_path)
 
-                text_str = ' '.join(text)
-                target_str = ' '.join(target)
 
-                output = {'text': text_str,
-                          'target': target_str}
-                output.update(get_lexical_relations_seq(text))
-                outputs.append(output)
+# Each corpus type is described by a `count_*_windows(tokens)` function and an
+# `annotate_*_window(tokens, idx, rng)` function which returns the output dict
+# for window `idx`, or None if the window is skipped. `annotate_windows` drives
+# them either serially or over contiguous shards in a process pool.
 
-            print('{}/{}\r'.format(i, num_batches), end='\r')
-
-        for output in outputs:
-            out_file.write(str(json.dumps(output)) + '\n')
+def count_rnn_windows(tokens):
+    num_batches = int(math.ceil(len(tokens)/args.batch_size))
+    if num_batches - 1 < args.bptt:
+        return 0
+    return ((num_batches - 1 - args.bptt) // args.bptt + 1) * args.batch_size
 
-def create_glove_corpus(in_path, out_path):
-    tokens = get_tokens_from_file(in_path, add_eos=False)
+def annotate_rnn_window(tokens, idx, rng):
+    # Column k of the batchified corpus is tokens[k*num_batches:(k+1)*num_batches],
+    # window idx reads bptt tokens of every column in turn.
+    num_batches = int(math.ceil(len(tokens)/args.batch_size))
+    i = (idx // args.batch_size) * args.bptt
+    start = (idx % args.batch_size) * num_batches
+    end = min(start + num_batches, len(tokens))
 
-    with codecs.open(out_path, 'w', encoding="utf-8") as out_file:
-        outputs = []
-        for i, token in enumerate(tokens):
+    text = tokens[start + i:min(start + i + args.bptt, end)]
+    if len(text) == 0:
+        return None
 
-            if not token:
-                continue
+    target = tokens[start + i + 1:min(start + i + 1 + args.bptt, end)]
 
-            output = get_lexical_relations_seq([token])
-            output['text'] = token
-            output['target'] = token
-            outputs.append(output)
-            print('{0}\r'.format(i), end='\r')
+    output = {'text': ' '.join(text),
+              'target': ' '.join(target)}
+    output.update(get_lexical_relations_seq(text, rng))
+    return output
 
-        for output in outputs:
-            out_file.write(str(json.dumps(output)) + '\n')
+def count_glove_windows(tokens):
+    return len(tokens)
 
-def create_cbow_corpus(in_path, out_path):
-    tokens = get_tokens_from_file(in_path, add_eos=False)
-    context=4
+def annotate_glove_window(tokens, idx, rng):
+    token = tokens[idx]
+    if not token:
+        return None
 
-    with codecs.open(out_path, 'w', encoding="utf-8") as out_file:
-        for i in range(4, len(tokens)-4):
-            text = tokens[i-4:i] + tokens[i+1:i+5]
-            target = tokens[i]
+    output = get_lexical_relations_seq([token], rng)
+    output['text'] = token
+    output['target'] = token
+    return output
 
-            text_str = ' '.join(text)
+def count_cbow_windows(tokens):
+    return max(len(tokens) - 8, 0)
 
-            output = get_lexical_relations_seq([target])
-            output['text'] = text_str
-            output['target'] = target
+def annotate_cbow_window(tokens, idx, rng):
+    i = idx + 4
+    text = tokens[i-4:i] + tokens[i+1:i+5]
+    target = tokens[i]
 
-            out_file.write(str(json.dumps(output)) + '\n')
-            out_file.flush()
+    output = get_lexical_relations_seq([target], rng)
+    output['text'] = ' '.join(text)
+    output['target'] = target
+    return output
 
-def create_skipgram_corpus(in_path, out_path):
-    tokens, w2freq = get_tokens_with_dict(in_path, add_eos=False)
-    total = sum(w2freq.values(), 0.0)
-    w2freq = {key:w2freq[key]/total for key in w2freq.keys()}
+skipgram_context = 4
+w2freq = {}
 
-    context=4
+def count_skipgram_windows(tokens):
+    return max(len(tokens) - 2 * skipgram_context, 0)
 
-    with codecs.open(out_path, 'w', encoding="utf-8") as out_file:
-        for i in range(context, len(tokens)-context):
-            text = tokens[i]
-            p = 1. - math.sqrt(1e-5/w2freq[text])
-            if random.random() > p:
-                output = get_lexical_relations_seq([text])
+def annotate_skipgram_window(tokens, idx, rng):
+    i = idx + skipgram_context
+    text = tokens[i]
+    p = 1. - math.sqrt(1e-5/w2freq[text])
+    if rng.random() <= p:
+        return None
 
-                output['text'] = text
-                target = tokens[i-context:i] + tokens[i+1:i+context+1]
-                output['target'] = ' '.join(target)
+    output = get_lexical_relations_seq([text], rng)
+    output['text'] = text
+    target = tokens[i-skipgram_context:i] + tokens[i+1:i+skipgram_context+1]
+    output['target'] = ' '.join(target)
+    return output
+
+# Set by `annotate_windows` before the pool is forked so that every worker
+# inherits the tokens without pickling them. The relation index is memory-mapped
+# and shared the same way.
+shard_tokens = None
+shard_annotate_window = None
+# Corpus tokens per window, averaged over the whole corpus, for the tokens/s
+# of the progress line. Set by `annotate_windows` as well.
+tokens_per_window = 1.
+
+def report_progress(done, total, tokens_done, start_time, prefix=''):
+    elapsed = max(time.time() - start_time, 1e-6)
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print('{}{}/{} windows | {:8.0f} tokens/s | peak rss {:6.0f} MB'.format(
+            prefix, done, total, tokens_done / elapsed, peak_rss), end='\r')
+
+def iter_annotated_windows(annotate_window, tokens, start, end, prefix=''):
+    """Yields (idx, output) for every window in [start, end), output is None for skipped windows.
+
+    `start` must be on an RNG block boundary.
+    """
+    num_windows = end - start
+    start_time = time.time()
+    rng = None
+    for idx in range(start, end):
+        if idx % RNG_BLOCK == 0 or rng is None:
+            rng = random.Random(args.seed * 1000003 + idx // RNG_BLOCK)
+
+        yield idx, annotate_window(tokens, idx, rng)
+
+        if (idx - start) % 10000 == 0:
+            report_progress(idx - start, num_windows, (idx - start) * tokens_per_window, start_time, prefix)
+
+    report_progress(num_windows, num_windows, num_windows * tokens_per_window, start_time, prefix)
+    print()
+
+def load_checkpoint(path):
+    try:
+        with open(path + '.ckpt') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
 
-                out_file.write(str(json.dumps(output)) + '\n')
-                out_file.flush()
+def save_json(path, obj):
+    # write-then-rename so that a crash never leaves a truncated file behind
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def write_windows(annotate_window, tokens, shard, prefix=''):
+    """Annotates the windows of `shard`, resuming from its last checkpoint.
+
+    The checkpoint (`<path>.ckpt`) holds the first window whose output is not
+    in the file yet and the byte offset at which that output starts.
+    """
+    n, start, end, path = shard
+    ckpt = load_checkpoint(path)
+    if ckpt is None or not os.path.exists(path):
+        ckpt = {'window': start, 'bytes': 0}
+    with open(path, 'ab') as f:
+        f.truncate(ckpt['bytes'])
+    if ckpt['window'] >= end:
+        return
+
+    if ckpt['window'] > start:
+        print('{}Resuming at window {} (byte {})'.format(prefix, ckpt['window'], ckpt['bytes']))
+
+    with RecordWriter(path, args.write_batch, args.write_buffer, append=True) as writer:
+        for idx, output in iter_annotated_windows(annotate_window, tokens, ckpt['window'], end, prefix):
+            if output is not None:
+                writer.write(output)
+
+            if (idx + 1) % checkpoint_windows == 0 or idx + 1 == end:
+                writer.sync()
+                save_json(path + '.ckpt', {'window': idx + 1, 'bytes': writer.tell()})
+
+def annotate_shard(shard):
+    write_windows(shard_annotate_window, shard_tokens, shard, prefix='[shard {}] '.format(shard[0]))
+    return shard[3]
+
+def annotate_windows(count_windows, annotate_window, tokens, out_path, entry):
+    """Annotates every window of `tokens` into `out_path`.
+
+    The shard layout is kept in the manifest `entry` of the split, so an
+    interrupted run resumes with the same shards whatever `--workers` is.
+    """
+    global shard_tokens, shard_annotate_window, tokens_per_window
+
+    if 'shards' not in entry:
+        num_windows = count_windows(tokens)
+        if args.workers <= 1:
+            shards = [(0, 0, num_windows, out_path)]
+        else:
+            num_blocks = int(math.ceil(num_windows / RNG_BLOCK))
+            blocks_per_shard = max(int(math.ceil(num_blocks / args.workers)), 1)
+            shards = []
+            for n, block in enumerate(range(0, num_blocks, blocks_per_shard)):
+                start = block * RNG_BLOCK
+                end = min((block + blocks_per_shard) * RNG_BLOCK, num_windows)
+                shards.append((n, start, end, '{}.shard{:03d}'.format(out_path, n)))
+
+        entry.update({'tokens': len(tokens), 'windows': num_windows, 'shards': shards})
+        save_manifest()
+
+    shards = [tuple(shard) for shard in entry['shards']]
+    # a shard, or what is left of it after a resume, covers only part of the tokens
+    tokens_per_window = entry['tokens'] / max(entry['windows'], 1)
+    if len(shards) == 1 and shards[0][3] == out_path:
+        write_windows(annotate_window, tokens, shards[0])
+        return
+
+    shard_tokens = tokens
+    shard_annotate_window = annotate_window
+    # unlike Pool, the executor raises BrokenProcessPool when a worker dies
+    # (e.g. killed by the OOM killer) instead of waiting for it forever
+    with ProcessPoolExecutor(max(min(args.workers, len(shards)), 1),
+                             mp_context=multiprocessing.get_context('fork')) as pool:
+        shard_paths = list(pool.map(annotate_shard, shards))
+    shard_tokens = None
+    shard_annotate_window = None
+
+    if args.keep_shards:
+        return
+
+    with open(out_path, 'wb') as out_file:
+        for shard_path in shard_paths:
+            with open(shard_path, 'rb') as shard_file:
+                shutil.copyfileobj(shard_file, out_file)
+
+def create_rnn_corpus(in_path, out_path, entry):
+    tokens = TokenArray(in_path, out_path + '.ids', add_eos=True)
+    annotate_windows(count_rnn_windows, annotate_rnn_window, tokens, out_path, entry)
+    tokens.close()
+
+def create_glove_corpus(in_path, out_path, entry):
+    tokens = TokenArray(in_path, out_path + '.ids', add_eos=False)
+    annotate_windows(count_glove_windows, annotate_glove_window, tokens, out_path, entry)
+    tokens.close()
+
+def create_cbow_corpus(in_path, out_path, entry):
+    tokens = TokenArray(in_path, out_path + '.ids', add_eos=False)
+    annotate_windows(count_cbow_windows, annotate_cbow_window, tokens, out_path, entry)
+    tokens.close()
+
+def create_skipgram_corpus(in_path, out_path, entry):
+    tokens = TokenArray(in_path, out_path + '.ids', add_eos=False)
+    counts = tokens.counts()
+    total = sum(counts.values(), 0.0)
+    w2freq.clear()
+    w2freq.update({key:counts[key]/total for key in counts.keys()})
+
+    annotate_windows(count_skipgram_windows, annotate_skipgram_window, tokens, out_path, entry)
+    tokens.close()
+
+def file_fingerprint(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return {'size': os.path.getsize(path), 'md5': md5.hexdigest()}
+
+def load_manifest():
+    try:
+        with open(os.path.join(out_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest():
+    save_json(os.path.join(out_dir, 'manifest.json'), manifest)
+
+def annotation_config():
+    return {'model': args.model, 'bptt': args.bptt, 'batch_size': args.batch_size,
+            'max_pair': args.max_pair, 'seed': args.seed, 'keep_shards': args.keep_shards,
+            'text_only': args.text_only, 'relations': relation_key()}
+
+def create_split(in_file, out_file):
+    """Annotates one split unless the manifest says it is already done.
+
+    Returns True if the split was (re)annotated.
+    """
+    in_path = os.path.join(args.data, in_file)
+    out_path = os.path.join(out_dir, out_file)
+    fingerprint = {'input': file_fingerprint(in_path), 'config': annotation_config()}
+
+    entry = manifest.get(out_file)
+    if entry is not None and entry['fingerprint'] == fingerprint and entry['complete']:
+        print('Skipping %s, already annotated' % out_file)
+        changed = False
+    else:
+        if entry is None or entry['fingerprint'] != fingerprint:
+            # drop the checkpoints of a run with other inputs or settings
+            for shard in (entry or {}).get('shards', []):
+                if os.path.exists(shard[3] + '.ckpt'):
+                    os.remove(shard[3] + '.ckpt')
+            entry = {'fingerprint': fingerprint, 'complete': False}
+            manifest[out_file] = entry
+            save_manifest()
+
+        create_corpus(in_path, out_path, entry)
+
+        entry['complete'] = True
+        save_manifest()
+        for shard in entry['shards']:
+            if os.path.exists(shard[3] + '.ckpt'):
+                os.remove(shard[3] + '.ckpt')
+            if shard[3] != out_path and not args.keep_shards:
+                os.remove(shard[3])
+        changed = True
+
+    if args.binary and not entry.get('binary'):
+        print('Writing binary corpus for %s' % out_file)
+        json_paths = [shard[3] for shard in entry['shards']] if args.keep_shards else [out_path]
+        write_binary_corpus(json_paths, os.path.splitext(out_path)[0] + '.bin',
+                            relation_fields=[] if args.text_only else RELATION_FIELDS)
+        entry['binary'] = True
+        save_manifest()
+        changed = True
+
+    return changed
 
 if args.model == 'retro':
     create_vocab(os.path.join(args.data, 'vocab.txt'), add_eos=False)
@@ -476,13 +827,21 @@ elif args.model == 'skipgram':
     create_corpus = create_skipgram_corpus
     train, valid, test = ['train.txt', 'valid.txt', 'test.txt']
 
-print('Creating train files')
-create_corpus(os.path.join(args.data, train), os.path.join(out_dir, 'train.txt'))
-print('Creating test files')
-create_corpus(os.path.join(args.data, test), os.path.join(out_dir, 'test.txt'))
-print('Creating valid files')
-create_corpus(os.path.join(args.data, valid), os.path.join(out_dir, 'valid.txt'))
-if args.model == 'retro' and not args.from_file:
+if not args.no_index:
+    relation_index = load_relation_index()
+    if args.build_index:
+        sys.exit(0)
+
+manifest = load_manifest()
+changed = False
+for split, in_file in [('train', train), ('test', test), ('valid', valid)]:
+    print('Creating %s files' % split)
+    changed |= create_split(in_file, split + '.txt')
+
+# The global pair tables, also used to sample relations for text only corpora.
+if (args.model == 'retro' or args.text_only) and not args.from_file:
+    collect_global_relations(iter_tokens(os.path.join(args.data, train), add_eos=False))
+
     with open(os.path.join(args.data, 'syn_v{}.txt'.format(args.version)), 'w') as syn:
         for syn_pair in global_synonyms:
             syn.write('%s\t%s\n' % syn_pair)
@@ -499,5 +858,7 @@ if args.model == 'retro' and not args.from_file:
         for mer_pair in global_meronyms:
             mer.write('%s\t%s\n' % mer_pair)
 
-for pkl_file in glob.glob('/'.join([out_dir, '*.pkl'])):
-    os.remove(pkl_file)
+# Cached datasets built from the old annotations are stale now.
+if changed:
+    for pkl_file in glob.glob('/'.join([out_dir, '*.pkl'])):
+        os.remove(pkl_file)
@@ -0,0 +1,112 @@
+"""On-disk index of the WordNet relations of a vocabulary.
+
+Every relation type is stored in CSR layout: `<rel>_offsets.npy` (int64, one
+entry per word plus one) delimits the rows of `<rel>_pairs.npy` (int32, a pair
+of word ids per row) that belong to each word. Word ids refer to `words.txt`,
+whose first `num_vocab` entries are the vocabulary the index was built for;
+words that only appear inside relations are appended after them. The arrays
+are memory-mapped on load so forked workers share a single copy.
+"""
+import codecs
+import hashlib
+import json
+import os
+
+import numpy as np
+
+RELATIONS = ['synonyms', 'antonyms', 'hypernyms', 'hyponyms', 'meronyms', 'holonyms']
+
+
+def fingerprint(words, config):
+    """Hash of the vocabulary and of everything else the relations depend on."""
+    md5 = hashlib.md5(json.dumps(config, sort_keys=True).encode())
+    for w in words:
+        md5.update(w.encode('utf-8'))
+        md5.update(b'\n')
+    return md5.hexdigest()
+
+
+def save_index(path, words, table, key):
+    """Writes the relations in `table` (one dict of pair sets, or None, per word)."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    word2id = {w: i for i, w in enumerate(words)}
+    all_words = list(words)
+
+    def word_id(w):
+        if w not in word2id:
+            all_words.append(w)
+            word2id[w] = len(all_words) - 1
+        return word2id[w]
+
+    has_pos = np.array([rels is not None for rels in table], dtype=np.bool_)
+    np.save(os.path.join(path, 'has_pos.npy'), has_pos)
+
+    for rel in RELATIONS:
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        pairs = []
+        for i, rels in enumerate(table):
+            if rels is not None:
+                pairs.extend((word_id(a), word_id(b)) for a, b in sorted(rels[rel]))
+            offsets[i + 1] = len(pairs)
+
+        np.save(os.path.join(path, '{}_offsets.npy'.format(rel)), offsets)
+        np.save(os.path.join(path, '{}_pairs.npy'.format(rel)),
+                np.array(pairs, dtype=np.int32).reshape(-1, 2))
+
+    with codecs.open(os.path.join(path, 'words.txt'), 'w', encoding='utf-8') as f:
+        for w in all_words:
+            f.write(w + '\n')
+
+    # meta.json is written last, an index without it is incomplete.
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'key': key, 'num_vocab': len(words), 'num_words': len(all_words)}, f)
+
+
+def load_index(path, key):
+    """Returns the index at `path`, or None if it is missing or was built for another key."""
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if meta['key'] != key:
+        return None
+
+    return WordNetIndex(path, meta)
+
+
+class WordNetIndex(object):
+    def __init__(self, path, meta):
+        with codecs.open(os.path.join(path, 'words.txt'), 'r', encoding='utf-8') as f:
+            self.words = [line.rstrip('\n') for line in f]
+        self.num_vocab = meta['num_vocab']
+        self.word2id = {w: i for i, w in enumerate(self.words[:self.num_vocab])}
+
+        self.has_pos = np.load(os.path.join(path, 'has_pos.npy'), mmap_mode='r')
+        self.offsets = {}
+        self.pairs = {}
+        for rel in RELATIONS:
+            self.offsets[rel] = np.load(os.path.join(path, '{}_offsets.npy'.format(rel)), mmap_mode='r')
+            self.pairs[rel] = np.load(os.path.join(path, '{}_pairs.npy'.format(rel)), mmap_mode='r')
+
+    def __contains__(self, word):
+        return word in self.word2id
+
+    def __len__(self):
+        return self.num_vocab
+
+    def relations(self, word):
+        """Returns the relation pair sets of `word`, or None if it has no WordNet pos."""
+        idx = self.word2id[word]
+        if not self.has_pos[idx]:
+            return None
+
+        words = self.words
+        rels = {}
+        for rel in RELATIONS:
+            pairs = self.pairs[rel][self.offsets[rel][idx]:self.offsets[rel][idx + 1]].tolist()
+            rels[rel] = set((words[a], words[b]) for a, b in pairs)
+        return rels
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nce import LogUniformSampler, build_sampler
+
+
+def test_log_uniform_skips_special_tokens():
+    noise, sampler = build_sampler('log_uniform', torch.ones(1000))
+    # <unk> and <pad> of a torchtext vocab are never noise
+    assert noise[0] == 0 and noise[1] == 0
+    assert noise[2] > noise[3] > 0
+    assert abs(noise.sum().item() - 1) < 1e-5
+    assert sampler.draw(10000).min().item() >= 2
+
+
+def test_log_uniform_draws_match_probs():
+    torch.manual_seed(0)
+    sampler = LogUniformSampler(50, num_special=2)
+    counts = torch.bincount(sampler.draw(200000), minlength=50).float() / 200000
+    assert counts.size(0) == 50
+    assert (counts - sampler.probs).abs().max().item() < 0.01